@@ -8,8 +8,9 @@ from . import config
 from .kodiutils import (addon_version, browsesingle, delete, exists, get_proxies, get_setting, get_setting_bool, get_setting_float, get_setting_int, jsonrpc,
                         kodi_to_ascii, kodi_version, listdir, localize, log, notification, ok_dialog, progress_dialog, select_dialog,
                         set_setting, set_setting_bool, textviewer, translate_path, yesno_dialog)
-from .utils import arch, download_path, http_download, parse_version, remove_tree, system_os, temp_path, unzip, userspace64
-from .widevine.arm import dl_extract_widevine_chromeos, extract_widevine_chromeos, install_widevine_arm_chromeos
+from .utils import (arch, download_path, http_download, http_session, parse_version, remove_partials, remove_tree, system_os, temp_path, unzip,
+                    userspace64)
+from .widevine.arm import dl_extract_widevine_chromeos, extract_widevine_chromeos, install_widevine_arm_chromeos, remove_chromeos_indexes
 from .widevine.widevine import (backup_path, has_widevinecdm, ia_cdm_path,
                                 install_cdm_from_backup, latest_widevine_version,
                                 load_widevine_config, missing_widevine_libs, widevine_config_path,
@@ -62,10 +63,7 @@ class Helper:
             self.drm = config.DRM_SCHEMES[drm]
 
         # Add proxy support to HTTP requests
-        proxies = get_proxies()
-        if proxies:
-            from urllib.request import build_opener, install_opener, ProxyHandler
-            install_opener(build_opener(ProxyHandler(proxies)))
+        http_session().set_proxies(get_proxies())
 
     def __repr__(self):
         """String representation of Helper class"""
@@ -182,7 +180,7 @@ class Helper:
         dl_path = download_path(cdm.get('url'))
 
         if not exists(dl_path):
-            dl_path = http_download(cdm.get('url'))
+            dl_path = http_download(cdm.get('url'), connections=config.HTTP_DOWNLOAD_CONNECTIONS, mirrors=cdm.get('mirrors'))
 
         if dl_path:
             progress = progress_dialog()
@@ -272,6 +270,8 @@ class Helper:
             if widevinecdm:
                 log(0, 'Removed Widevine CDM at {path}', path=widevinecdm)
                 delete(widevinecdm)
+                remove_partials()
+                remove_chromeos_indexes()
                 notification(localize(30037), localize(30052))  # Success! Widevine successfully removed.
                 set_setting('last_modified', '0.0')
                 return True
@@ -380,6 +380,7 @@ class Helper:
             remove_tree(ia_cdm_path())
 
         remove_tree(temp_path())
+        remove_partials(max_age=config.HTTP_DOWNLOAD_PARTIAL_MAX_AGE)  # Recent ones are kept to resume interrupted downloads
         return True
 
     def _supports_hls(self):
@@ -79,6 +79,9 @@ WIDEVINE_CONFIG_NAME = 'manifest.json'
 
 CHROMEOS_RECOVERY_URL = 'https://dl.google.com/dl/edgedl/chromeos/recovery/recovery.json'
 
+# The Chrome OS recovery configuration is cached in the add-on profile, and revalidated with the server once its TTL expired
+CHROMEOS_RECOVERY_CACHE_FILE = 'chromeos_recovery.json'
+
 # To keep the Chrome OS ARM(64) hardware ID list up to date, the following resources can be used:
 # https://www.chromium.org/chromium-os/developer-information-for-chrome-os-devices
 # https://chromiumdash.appspot.com/serving-builds?deviceCategory=Chrome%20OS
@@ -108,6 +111,65 @@ CHROMEOS_RECOVERY_ARM64_BNAMES = [
 
 CHROMEOS_BLOCK_SIZE = 512
 
+# Where Widevine was found in Chrome OS images is saved in this file in the add-on profile, to extract it again quickly
+CHROMEOS_INDEX_FILE = 'chromeos_index.json'
+
+# Files extracted from the Chrome OS image together with the Widevine CDM, if they exist
+CHROMEOS_WIDEVINE_EXTRA_FILES = [
+    'opt/google/chrome/WidevineCdm/' + WIDEVINE_LICENSE_FILE,
+    'opt/google/chrome/WidevineCdm/' + WIDEVINE_MANIFEST_FILE,
+]
+
+# Inflate state of zipped Chrome OS images is saved every 32 MiB to speed up seeking backwards
+CHROMEOS_INFLATE_CHECKPOINT_INTERVAL = 32 * 1024 * 1024
+
+# A download of a zipped Chrome OS image that breaks off is resumed where it stopped, 3 times before asking to try again
+CHROMEOS_INFLATE_RETRIES = 3
+
+# Zipped Chrome OS images are inflated ahead in a separate thread, into at most 8 buffers of 1 MiB (0 disables this)
+CHROMEOS_INFLATE_AHEAD_BUFFERS = 8
+CHROMEOS_INFLATE_AHEAD_BUFFER_SIZE = 1024 * 1024
+
+# Consecutive blocks of a file in the Chrome OS image are read and written in extents of up to 4 MiB
+CHROMEOS_MAX_EXTENT_SIZE = 4 * 1024 * 1024
+
+# Number of recently read metadata blocks (inodes, indirect blocks, directories) of the Chrome OS image kept in memory
+CHROMEOS_BLOCK_CACHE_SIZE = 256
+
+# Python interpreter used to extract the Chrome OS image in a separate process, with the lowest CPU priority
+CHROMEOS_WORKER_PYTHON = 'python3'
+CHROMEOS_WORKER_NICENESS = 19
+
+# Uncompressed local images are scanned by one process per CPU core (or this many, 1 disables it) if over 256 MiB is left to scan
+CHROMEOS_SCAN_PROCESSES = 0
+CHROMEOS_PARALLEL_SCAN_MIN_SIZE = 256 * 1024 * 1024
+
+# Number of concurrent connections used to download large files from servers that accept byte ranges
+HTTP_DOWNLOAD_CONNECTIONS = 4
+
+# Files are only split into byte ranges if every connection gets at least this many bytes (1 MiB)
+HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024 * 1024
+
+# Resume information of single connection downloads is written to disk after every 16 MiB
+HTTP_DOWNLOAD_RESUME_INTERVAL = 16 * 1024 * 1024
+
+# Partial downloads of other files, or not written to for 3 days, are removed
+HTTP_DOWNLOAD_PARTIAL_MAX_AGE = 3 * 24 * 60 * 60
+
+# Downloaded chunks (of 256 KiB) waiting to be written and hashed on a separate thread, reading stalls when this many are queued
+HTTP_DOWNLOAD_QUEUE_SIZE = 16
+
+# Number of idle keep-alive connections kept open per host, and the number of redirects followed per request
+HTTP_POOL_SIZE = 4
+HTTP_MAX_REDIRECTS = 10
+
+# Mirrors of a download are raced by fetching their first 64 KiB concurrently, waiting at most 5 seconds for each of them
+HTTP_MIRROR_PROBE_SIZE = 64 * 1024
+HTTP_MIRROR_PROBE_TIMEOUT = 5
+
+# The download throughput per mirror host is remembered in the add-on profile, to prefer fast mirrors in the next races
+HTTP_MIRRORS_FILE = 'mirrors.json'
+
 MINIMUM_INPUTSTREAM_VERSION_ARM64 = {
     'inputstream.adaptive': '20.3.5',
 }
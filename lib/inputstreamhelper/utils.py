@@ -5,15 +5,19 @@
 import os
 import re
 import struct
+from base64 import b64encode
 from functools import total_ordering
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection, IncompleteRead, RemoteDisconnected
 from socket import timeout
 from ssl import SSLError
+from threading import Lock
 from time import time
 from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib.request import Request, urlopen, __version__ as urllib_version
 
 from . import config
-from .kodiutils import (bg_progress_dialog, copy, delete, exists, get_setting,
+from .kodiutils import (addon_profile, bg_progress_dialog, copy, delete, exists, get_setting,
                         localize, log, mkdirs, progress_dialog, set_setting,
                         stat_file, translate_path, yesno_dialog)
 from .unicodes import compat_path, from_unicode, to_unicode
@@ -60,10 +64,26 @@ def update_temp_path(new_temp_path):
     """"Updates temp_path and merges files."""
     old_temp_path = temp_path()
 
+    old_partial_path = partial_path()
+
     set_setting('temp_path', new_temp_path)
     if old_temp_path != temp_path():
         from shutil import move
         move(old_temp_path, temp_path())
+        for filename in os.listdir(compat_path(old_partial_path)):
+            move(os.path.join(compat_path(old_partial_path), filename), os.path.join(compat_path(partial_path()), filename))
+
+
+def partial_path():
+    """Return path for partial downloads, usually ~/.kodi/userdata/addon_data/script.module.inputstreamhelper/partial/
+
+    Unlike temp_path, this directory is not cleaned up, so interrupted downloads can be resumed later on.
+    """
+    part_path = translate_path(os.path.join(get_setting('temp_path', 'special://masterprofile/addon_data/script.module.inputstreamhelper'), 'partial', ''))
+    if not exists(part_path):
+        mkdirs(part_path)
+
+    return part_path
 
 
 def download_path(url):
@@ -73,24 +93,186 @@ def download_path(url):
     return os.path.join(temp_path(), filename)
 
 
+class PooledResponse(HTTPResponse):
+    """An HTTP response that remembers if it was closed before its body was read completely"""
+    discarded = False
+
+    def close(self):
+        """Close the response, its connection cannot be reused unless the whole body was read"""
+        if self.fp is not None and self.length != 0:
+            self.discarded = True
+        super().close()
+
+    def reusable(self):
+        """Whether the connection of this response can send the next request"""
+        return self.isclosed() and not self.discarded and not self.will_close
+
+
+class HTTPSession:
+    """
+    Sends HTTP requests over keep-alive connections, kept in a pool per host
+
+    Requests to the same host share their TCP and TLS handshakes, e.g. the repository query, EULA, catalog and download
+    of one install. A connection is only reused once its previous response was read completely.
+    Redirects and HTTP proxies are handled like urlopen does, SOCKS proxies are left to urlopen itself.
+    """
+
+    def __init__(self):
+        """Start without proxies and with an empty pool"""
+        self.proxies = None
+        self.pool = {}
+        self.lock = Lock()
+
+    def set_proxies(self, proxies):
+        """Use the given proxies dictionary from get_proxies() for the next requests"""
+        if proxies == self.proxies:
+            return
+        self.proxies = proxies
+        self.close()
+        if proxies:  # Used for SOCKS proxies and by urlopen elsewhere
+            from urllib.request import build_opener, install_opener, ProxyHandler
+            install_opener(build_opener(ProxyHandler(proxies)))
+
+    def _proxy(self, parts):
+        """
+        Return the split proxy URL for the split URL parts, None without a proxy and False for a SOCKS proxy
+
+        Without proxies from Kodi, the proxy environment variables (http_proxy, https_proxy and no_proxy) are used like urlopen does.
+        """
+        proxies = self.proxies
+        if not proxies:
+            from urllib.request import getproxies, proxy_bypass
+            proxies = getproxies()
+            if proxies.get(parts.scheme) and proxy_bypass(parts.hostname or ''):
+                return None
+        if not proxies.get(parts.scheme):
+            return None
+        proxy = urlsplit(proxies[parts.scheme])
+        if proxy.scheme not in ('http', 'https'):
+            return False
+        return proxy
+
+    @staticmethod
+    def _proxy_headers(proxy):
+        """Return the Proxy-Authorization header for the credentials in the proxy URL"""
+        if not proxy or not proxy.username:
+            return {}
+        credentials = '{}:{}'.format(unquote(proxy.username), unquote(proxy.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+    def _connect(self, parts, proxy, time_out):
+        """Return a reusable pooled connection to the host of parts, or a new one and whether it was reused"""
+        with self.lock:
+            connections = self.pool.get((parts.scheme, parts.netloc), [])
+            for connection, response in list(connections):
+                if not response.isclosed():  # Still in use
+                    continue
+                connections.remove((connection, response))
+                if response.reusable():
+                    connection.timeout = time_out
+                    if connection.sock:
+                        connection.sock.settimeout(time_out)
+                    return connection, True
+                connection.close()
+
+        if not proxy:
+            connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+            connection = connection_class(parts.hostname, parts.port, timeout=time_out)
+        elif parts.scheme == 'https':
+            connection = HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=time_out)
+            connection.set_tunnel(parts.hostname, parts.port, headers=self._proxy_headers(proxy))
+        else:
+            connection = HTTPConnection(proxy.hostname, proxy.port or 80, timeout=time_out)
+        connection.response_class = PooledResponse
+        return connection, False
+
+    def _send(self, url, method, data, headers, time_out):
+        """Send one request, retrying on a new connection if the server already closed the reused one"""
+        parts = urlsplit(url)
+        proxy = self._proxy(parts)
+        path = url if proxy and parts.scheme == 'http' else (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = dict({'User-Agent': 'Python-urllib/' + urllib_version}, **headers)
+        if parts.scheme == 'http':
+            headers.update(self._proxy_headers(proxy))
+
+        while True:
+            connection, reused = self._connect(parts, proxy, time_out)
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+            except (BrokenPipeError, ConnectionResetError, RemoteDisconnected):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+            with self.lock:
+                connections = self.pool.setdefault((parts.scheme, parts.netloc), [])
+                idle = [entry for entry in connections if entry[1].isclosed()]
+                for entry in idle[:max(len(idle) + 1 - config.HTTP_POOL_SIZE, 0)]:
+                    connections.remove(entry)
+                    entry[0].close()
+                connections.append((connection, response))
+            return response
+
+    def open(self, url, data=None, headers=None, method=None, time_out=10):
+        """Perform an HTTP request and return the response, raises HTTPError and URLError like urlopen"""
+        if self._proxy(urlsplit(url)) is False:
+            request = Request(url, data=data, headers=headers or {}, method=method)
+            return urlopen(request, timeout=time_out)
+
+        method = method or ('POST' if data else 'GET')
+        for _ in range(config.HTTP_MAX_REDIRECTS + 1):
+            try:
+                response = self._send(url, method, data, headers or {}, time_out)
+            except (OSError, HTTPException) as err:
+                raise URLError(err) from err
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            response.read()
+            url = urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method, data = 'GET', None
+        if response.status >= 400 or response.status in (301, 302, 303, 307, 308):
+            raise HTTPError(url, response.status, response.reason, response.headers, response)
+        return response
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            for connections in self.pool.values():
+                for connection, response in connections:
+                    if response.isclosed():
+                        connection.close()
+            self.pool.clear()
+
+
+def http_session():
+    """Return the HTTP session shared by all requests, use a static variable to remember"""
+    if not hasattr(http_session, 'session'):
+        http_session.session = HTTPSession()
+    return http_session.session
+
+
 def _http_request(url, data=None, headers=None, time_out=10):
     """Perform an HTTP request and return response"""
     log(0, 'Request URL: {url}', url=url)
 
     try:
-        request = Request(url)
-        if headers:
-            request.headers = headers
-        if data:
-            request.data = data
-        response = urlopen(request, timeout=time_out)  # pylint: disable=consider-using-with
+        response = http_session().open(url, data=data, headers=headers, time_out=time_out)
         log(0, 'Response code: {code}', code=response.getcode())
         if 400 <= response.getcode() < 600:
             raise HTTPError
     except (HTTPError, URLError) as err:
+        if isinstance(err, HTTPError) and err.code == 304:  # Not modified, urlopen raises this for conditional requests
+            return err
         log(2, 'Download failed with error {}'.format(err))
         if yesno_dialog(localize(30004), '{line1}\n{line2}'.format(line1=localize(30063), line2=localize(30065))):  # Internet down, try again?
-            return _http_request(url, headers, time_out)
+            return _http_request(url, data=data, headers=headers, time_out=time_out)
         return None
     return response
 
@@ -107,12 +289,15 @@ def http_get(url):
     return content.decode("utf-8")
 
 
+def http_stream(url, headers=None):
+    """Perform an HTTP GET request and return the response, to be read as a stream"""
+    return _http_request(url, headers=headers)
+
+
 def http_head(url):
     """Perform an HTTP HEAD request and return status code"""
-    req = Request(url)
-    req.get_method = lambda: 'HEAD'
     try:
-        with urlopen(req) as response:
+        with http_session().open(url, method='HEAD') as response:
             return response.getcode()
     except HTTPError as exc:
         return exc.getcode()
@@ -130,19 +315,520 @@ def http_post(url, data, headers):
     return content.decode("utf-8")
 
 
-def http_download(url, message=None, checksum=None, hash_alg='sha1', dl_size=None, background=False):  # pylint: disable=too-many-positional-arguments, too-many-statements
-    """Makes HTTP request and displays a progress dialog on download."""
-    if checksum:
-        from hashlib import md5, sha1
-        if hash_alg == 'sha1':
-            calc_checksum = sha1()
-        elif hash_alg == 'md5':
-            calc_checksum = md5()
-        else:
-            log(4, 'Invalid hash algorithm specified: {}'.format(hash_alg))
-            checksum = None
+class ChunkWorker:
+    """
+    Passes chunks of a download to its consumers (e.g. writing and hashing them) on a separate thread
+
+    The chunks are fed through a bounded queue. hashlib and file writes release the GIL on large chunks,
+    so reading from the network, writing to disk and hashing proceed in parallel.
+    """
+
+    def __init__(self, *consumers):
+        """Start the thread that passes chunks to the consumers"""
+        from queue import Queue
+        from threading import Thread
+        self.consumers = consumers
+        self.queue = Queue(config.HTTP_DOWNLOAD_QUEUE_SIZE)
+        self.error = None
+        self.thread = Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _consume(self):
+        """Pass every queued chunk to the consumers, until the queue yields None"""
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self.error is None:
+                    for consumer in self.consumers:
+                        consumer(chunk)
+            except Exception as err:  # pylint: disable=broad-except
+                self.error = err  # Passed on to the downloading thread, which would otherwise block on a full queue
+            finally:
+                self.queue.task_done()
+
+    def put(self, chunk):
+        """Queue a chunk, raises the error of a consumer if one failed"""
+        if self.error:
+            raise self.error
+        self.queue.put(chunk)
+
+    def sync(self):
+        """Wait until all queued chunks are consumed, raises the error of a consumer if one failed"""
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """Stop the thread after the queued chunks are consumed"""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _mirrors_path():
+    """Return the path to the remembered download throughput of mirror hosts"""
+    return os.path.join(addon_profile(), config.HTTP_MIRRORS_FILE)
+
+
+def _load_mirror_speeds():
+    """Load the remembered download throughput in bytes per second, keyed by mirror host"""
+    if not exists(_mirrors_path()):
+        return {}
+    from json import load
+    try:
+        with open(compat_path(_mirrors_path()), 'r', encoding='utf-8') as mirrors_file:
+            return load(mirrors_file)
+    except (OSError, ValueError):
+        return {}
 
-    req = _http_request(url)
+
+def _save_mirror_speed(url, speed):
+    """Remember the download throughput of the host of url, averaged with what was remembered before"""
+    speeds = _load_mirror_speeds()
+    host = urlsplit(url).netloc
+    speeds[host] = (speeds[host] + speed) / 2 if host in speeds else speed
+    from json import dump
+    with open(compat_path(_mirrors_path()), 'w', encoding='utf-8') as mirrors_file:
+        dump(speeds, mirrors_file)
+
+
+def _count_mirror(stats, url, num_of_bytes, seconds):
+    """Add bytes downloaded from a mirror and the seconds it took to the download statistics of that mirror"""
+    totals = stats.setdefault(url, [0, 0.0])
+    totals[0] += num_of_bytes
+    totals[1] += seconds
+
+
+def _same_file(req, state):
+    """Whether a byte range response of a mirror has the validator and size of the download, so it can be resumed from"""
+    validator = req.info().get('etag') or req.info().get('last-modified')
+    return validator == state['validator'] and req.info().get('content-range', '').endswith('/{}'.format(state['size']))
+
+
+def _probe_mirror(url, speeds):
+    """Measure how fast the first bytes of url arrive, meant to run in its own thread"""
+    starttime = time()
+    try:
+        with http_session().open(url, headers={'Range': 'bytes=0-{}'.format(config.HTTP_MIRROR_PROBE_SIZE - 1)},
+                                 time_out=config.HTTP_MIRROR_PROBE_TIMEOUT) as req:
+            size = len(req.read(config.HTTP_MIRROR_PROBE_SIZE))
+    except (HTTPError, URLError, OSError, HTTPException) as err:
+        log(2, 'Mirror {url} failed with error {err}', url=url, err=err)
+        return
+    speeds[url] = size / max(time() - starttime, 0.001)
+
+
+def rank_mirrors(urls):
+    """Return the mirrors of a download fastest first, racing them concurrently and preferring hosts that were fast before"""
+    if len(urls) < 2:
+        return list(urls)
+
+    from threading import Thread
+    speeds = {}
+    threads = [Thread(target=_probe_mirror, args=(url, speeds)) for url in urls]
+    deadline = time() + 2 * config.HTTP_MIRROR_PROBE_TIMEOUT
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - time(), 0))
+
+    remembered = _load_mirror_speeds()
+
+    def speed(url):
+        """The measured speed of a mirror, averaged with its remembered throughput, or -1 if it failed to respond"""
+        if url not in speeds:
+            return -1
+        host = urlsplit(url).netloc
+        return (speeds[url] + remembered[host]) / 2 if host in remembered else speeds[url]
+
+    ranked = sorted(urls, key=speed, reverse=True)
+    log(0, 'Mirrors ranked by speed: {ranked}', ranked=['{} ({:.0f} B/s)'.format(url, speed(url)) for url in ranked])
+    return ranked
+
+
+def _partial_download(url):
+    """Return the path of the partial download of url and the path of its sidecar file with resume information"""
+    part_path = os.path.join(partial_path(), url.split('/')[-1] + '.part')
+    return part_path, part_path + '.json'
+
+
+def _load_partial(url, total_length, validator):
+    """Return the resume information of an earlier partial download of url, as long as the remote file did not change"""
+    part_path, sidecar_path = _partial_download(url)
+    if not exists(part_path) or not exists(sidecar_path):
+        return None
+
+    from json import load
+    try:
+        with open(compat_path(sidecar_path), 'r', encoding='utf-8') as sidecar:
+            state = load(sidecar)
+    except (OSError, ValueError):
+        state = {}
+
+    if state.get('url') != url or state.get('size') != total_length or state.get('validator') != validator:
+        log(2, 'Discarding partial download of {url}, the remote file changed', url=url)
+        _remove_partial(url)
+        return None
+
+    log(0, 'Found partial download of {url}', url=url)
+    return state
+
+
+def _save_partial(state, image=None):
+    """Store the resume information of a partial download, after making sure the downloaded bytes are on disk"""
+    # Range threads keep advancing the segments, only what was written before the fsync may be recorded as done
+    state = dict(state, segments=[list(segment) for segment in state['segments']])
+    part_path, sidecar_path = _partial_download(state['url'])
+    if image is None:
+        with open(compat_path(part_path), 'rb') as part:
+            os.fsync(part.fileno())
+    else:
+        image.flush()
+        os.fsync(image.fileno())
+
+    from json import dump
+    with open(compat_path(sidecar_path + '.tmp'), 'w', encoding='utf-8') as sidecar:
+        dump(state, sidecar)
+    os.replace(compat_path(sidecar_path + '.tmp'), compat_path(sidecar_path))
+
+
+def _remove_partial(url):
+    """Remove the partial download of url and its resume information"""
+    for path in _partial_download(url):
+        if exists(path):
+            delete(path)
+
+
+def remove_partials(keep_url=None, max_age=None):
+    """
+    Remove partial downloads and their resume information from partial_path(), all of them by default
+
+    With keep_url, the partial downloads of other urls are removed. With max_age, those not written to for max_age seconds are removed.
+    """
+    from json import load
+    part_dir = partial_path()
+    partials = {}
+    for filename in os.listdir(compat_path(part_dir)):
+        name = re.sub(r'(\.json)?(\.tmp)?$', '', filename)
+        partials.setdefault(name, []).append(os.path.join(part_dir, filename))
+
+    now = time()
+    for name, paths in partials.items():
+        remove = keep_url is None and max_age is None
+        if max_age is not None and now - max(os.path.getmtime(compat_path(path)) for path in paths) > max_age:
+            remove = True
+        if keep_url and not remove:
+            try:
+                with open(compat_path(os.path.join(part_dir, name + '.json')), 'r', encoding='utf-8') as sidecar:
+                    remove = load(sidecar).get('url') != keep_url
+            except (OSError, ValueError):
+                remove = True
+        if remove:
+            log(0, 'Removing partial download {name}', name=name)
+            for path in paths:
+                delete(path)
+
+
+def _progress_message(message, starttime, done, left):
+    """Return the progress dialog message, including the remaining time once it can be estimated"""
+    if time() - starttime > 5 and done:
+        time_left = int(round(left * (time() - starttime) / done))
+        return '{line1}\n{line2}'.format(
+            line1=message,
+            line2=localize(30058, mins=time_left // 60, secs=time_left % 60))  # Time remaining
+    return message
+
+
+def _accepts_ranges(req, total_length, connections):
+    """Whether a download is worth splitting into byte ranges and the server advertises support for it"""
+    if connections < 2 or total_length < connections * config.HTTP_DOWNLOAD_MIN_RANGE_SIZE:
+        return False
+    return req.info().get('accept-ranges', '').lower() == 'bytes'
+
+
+def _split_segments(segments, connections):
+    """Split the remaining byte ranges of a download so that every connection gets one"""
+    remaining = [segment for segment in segments if segment[0] <= segment[1]]
+    if not remaining or len(remaining) >= connections:
+        return remaining
+
+    split = []
+    pieces = connections // len(remaining)
+    for start, end in remaining:
+        range_size = -(-(end - start + 1) // pieces)  # ceiling division
+        split.extend([pos, min(pos + range_size - 1, end)] for pos in range(start, end + 1, range_size))
+    return split
+
+
+def _download_range(urls, part_path, segment, abort, state):
+    """Download a byte range of the mirrors in urls into the same range of part_path, meant to run in its own thread"""
+    chunk_size = 256 * 1024
+    retries = 3
+    mirror = 0
+    stats = {}
+    state['mirrors'].append(stats)
+    with open(compat_path(part_path), 'r+b', buffering=0) as image:  # unbuffered, so segment always matches what is on disk
+        while segment[0] <= segment[1] and not abort.is_set():
+            url = urls[mirror % len(urls)]
+            starttime = time()
+            start = segment[0]
+            try:
+                with http_session().open(url, headers={'Range': 'bytes={}-{}'.format(*segment)}) as req:
+                    if req.getcode() != 206:  # Server ignored our Range header
+                        state['ranges_ignored'] = True
+                        abort.set()
+                        return
+                    if not _same_file(req, state['download']):
+                        raise URLError('{url} serves another version of the file'.format(url=url))
+                    image.seek(segment[0])
+                    while segment[0] <= segment[1] and not abort.is_set():
+                        chunk = req.read(min(chunk_size, segment[1] - segment[0] + 1))
+                        if not chunk:
+                            raise IncompleteRead(b'', segment[1] - segment[0] + 1)
+                        image.write(chunk)
+                        segment[0] += len(chunk)
+            except (HTTPError, URLError, OSError, timeout, SSLError, HTTPException) as err:
+                retries -= 1
+                if retries < 0:
+                    log(2, 'Download of range {start}-{end} failed with error {err}', start=segment[0], end=segment[1], err=err)
+                    return
+                mirror += 1  # Continue from the next mirror, if there are more
+                log(0, 'Retrying download of range {start}-{end} from {url} after error {err}',
+                    start=segment[0], end=segment[1], url=urls[mirror % len(urls)], err=err)
+            finally:
+                _count_mirror(stats, url, segment[0] - start, time() - starttime)
+
+
+def _http_download_ranges(urls, part_path, state, connections, progress, message, background, stats):  # pylint: disable=too-many-positional-arguments
+    """
+    Download the mirrors in urls into a preallocated file over several concurrent connections, each fetching its own byte range
+
+    The bytes downloaded from every mirror and the time it took are added to stats.
+    """
+    from hashlib import new
+    from threading import Event, Thread
+
+    total_length = state['size']
+    with open(compat_path(part_path), 'r+b' if exists(part_path) else 'wb') as image:
+        image.truncate(total_length)
+
+    segments = _split_segments(state['segments'], connections)
+    state.update(segments=segments, digest=None)  # the digest is calculated over the complete file, while and after downloading
+    abort = Event()
+    ranges_state = {'download': state, 'mirrors': []}
+    starttime = time()
+    start_left = sum(segment[1] - segment[0] + 1 for segment in segments)
+    calc_checksum = new(state['hash_alg'])
+    worker = ChunkWorker(calc_checksum.update)
+    hashed = 0
+    try:
+        while True:
+            threads = [Thread(target=_download_range, args=(urls, part_path, segment, abort, ranges_state)) for segment in segments if segment[0] <= segment[1]]
+            log(0, 'Downloading {url} over {num} connections', url=urls[0], num=len(threads))
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            saved_left = sum(segment[1] - segment[0] + 1 for segment in segments)
+            while any(thread.is_alive() for thread in threads):
+                abort.wait(0.5)
+                left = sum(segment[1] - segment[0] + 1 for segment in segments)
+                if not background and progress.iscanceled():
+                    abort.set()
+                if saved_left - left >= config.HTTP_DOWNLOAD_RESUME_INTERVAL:
+                    _save_partial(state)
+                    saved_left = left
+                progress.update(int(round((total_length - left) * 100 / total_length)), _progress_message(message, starttime, start_left - left, left))
+                downloaded = next((segment[0] for segment in segments if segment[0] <= segment[1]), total_length)
+                hashed = _hash_file(part_path, worker, hashed, downloaded)  # Hash the downloaded start of the file meanwhile
+
+            for thread in threads:
+                thread.join()
+            _save_partial(state)
+            for thread_stats in ranges_state['mirrors']:
+                for url, (num_of_bytes, seconds) in thread_stats.items():
+                    _count_mirror(stats, url, num_of_bytes, seconds)
+            ranges_state['mirrors'] = []
+
+            if ranges_state.get('ranges_ignored'):
+                log(2, 'Server does not honour byte ranges, parallel download of {url} aborted', url=urls[0])
+                return None
+            if abort.is_set():
+                return False
+            if all(segment[0] > segment[1] for segment in segments):
+                _hash_file(part_path, worker, hashed, total_length)
+                worker.sync()
+                state['digest'] = calc_checksum.hexdigest()
+                return True
+            if not yesno_dialog(localize(30004), '{line1}\n{line2}'.format(line1=localize(30064),
+                                                                           line2=localize(30065))):  # Could not finish dl. Try again?
+                return False
+    finally:
+        worker.close()
+
+
+def _hash_file(path, worker, start, end):
+    """Queue the bytes of a file from start up to end for hashing, returns the position up to where they were queued"""
+    with open(compat_path(path), 'rb') as image:
+        image.seek(start)
+        while start < end:
+            chunk = image.read(min(256 * 1024, end - start))
+            if not chunk:
+                break
+            worker.put(chunk)
+            start += len(chunk)
+    return start
+
+
+def _resume_checksum(part_path, state):
+    """Rebuild the running hash of a partial download from its verified bytes, returns None if they do not match the sidecar"""
+    from hashlib import new
+    calc_checksum = new(state['hash_alg'])
+    worker = ChunkWorker(calc_checksum.update)
+    try:
+        hashed = _hash_file(part_path, worker, 0, state['segments'][0][0])
+    finally:
+        worker.close()
+    if hashed < state['segments'][0][0]:
+        return None
+
+    if calc_checksum.hexdigest() != state.get('digest'):
+        log(2, 'Partial download {path} does not match its recorded checksum', path=part_path)
+        return None
+    return calc_checksum
+
+
+def _http_download_stream(req, urls, part_path, state, progress, message, background,  # pylint: disable=too-many-positional-arguments, too-many-statements
+                          stats):
+    """
+    Download the mirrors in urls into part_path over a single connection, resuming with a Range request after timeouts
+    or from an earlier partial download. When the download stalls or fails, it continues from the next mirror that serves
+    the same version of the file. After every mirror failed, it asks to try again.
+
+    The bytes downloaded from every mirror and the time it took are added to stats.
+    """
+    from hashlib import new
+    total_length = state['size']
+    size = 0
+    calc_checksum = None
+    if len(state['segments']) == 1 and state['segments'][0][0] and state.get('digest'):
+        calc_checksum = _resume_checksum(part_path, state)
+    if calc_checksum:
+        size = state['segments'][0][0]
+        log(2, 'Resuming download of {url} at byte {size}', url=urls[0], size=size)
+        if req is not None:
+            req.close()
+        req = _http_request(urls[0], headers={'Range': 'bytes={}-{}'.format(size, total_length)})
+        if req is None:
+            return None
+        if req.getcode() != 206:  # Server ignored our Range header, start over
+            size = 0
+    elif req is None:
+        req = _http_request(urls[0])
+        if req is None:
+            return None
+    if not size:
+        calc_checksum = new(state['hash_alg'])
+
+    starttime = mirror_time = time()
+    start_size = mirror_size = size
+    last_save = size
+    failures = 0
+    chunk_size = 256 * 1024
+    with open(compat_path(part_path), 'r+b' if size else 'wb') as image:
+        image.seek(size)
+        image.truncate()
+        worker = ChunkWorker(image.write, calc_checksum.update)
+        try:
+            while size < total_length:
+                try:
+                    chunk = req.read(chunk_size)
+                    if not chunk:
+                        raise IncompleteRead(b'', total_length - size)
+                except (timeout, SSLError, OSError, HTTPException) as err:
+                    req.close()
+                    worker.sync()
+                    _count_mirror(stats, urls[0], size - mirror_size, time() - mirror_time)
+                    state.update(segments=[[size, total_length - 1]], digest=calc_checksum.hexdigest())
+                    _save_partial(state, image)
+                    log(2, 'Download from {url} failed with error {err}', url=urls[0], err=err)
+
+                    while True:
+                        failures += 1
+                        if failures >= len(urls):  # Every mirror got a try
+                            if not yesno_dialog(localize(30004), '{line1}\n{line2}'.format(line1=localize(30064),
+                                                                                           line2=localize(30065))):  # Could not finish dl. Try again?
+                                return False
+                            failures = 0
+                        if len(urls) > 1:
+                            urls.append(urls.pop(0))
+                            log(2, 'Continuing download from {mirror}', mirror=urls[0])
+
+                        headers = {'Range': 'bytes={}-{}'.format(size, total_length)}
+                        req = _http_request(urls[0], headers=headers)
+                        if req is None:
+                            return None
+                        if req.getcode() != 206 or _same_file(req, state):
+                            break
+                        log(2, '{url} serves another version of the file, not resuming from it', url=urls[0])
+                        req.close()
+
+                    if req.getcode() != 206:  # Server ignored our Range header, start over
+                        size = last_save = 0
+                        calc_checksum = new(state['hash_alg'])
+                        worker.consumers = (image.write, calc_checksum.update)
+                        image.seek(0)
+                        image.truncate()
+                        state['validator'] = req.info().get('etag') or req.info().get('last-modified')
+                    mirror_size, mirror_time = size, time()
+                    continue
+
+                worker.put(chunk)
+                size += len(chunk)
+                failures = 0
+                if size - last_save >= config.HTTP_DOWNLOAD_RESUME_INTERVAL or size == total_length:
+                    worker.sync()
+                    state.update(segments=[[size, total_length - 1]], digest=calc_checksum.hexdigest())
+                    _save_partial(state, image)
+                    last_save = size
+                percent = int(round(size * 100 / total_length))
+                if not background and progress.iscanceled():
+                    req.close()
+                    worker.sync()
+                    _count_mirror(stats, urls[0], size - mirror_size, time() - mirror_time)
+                    state.update(segments=[[size, total_length - 1]], digest=calc_checksum.hexdigest())
+                    _save_partial(state, image)
+                    return False
+
+                progress.update(percent, _progress_message(message, starttime, size - start_size, total_length - size))
+        finally:
+            worker.close()
+
+    _count_mirror(stats, urls[0], size - mirror_size, time() - mirror_time)
+
+    req.close()
+    return True
+
+
+def http_download(url, message=None, checksum=None, hash_alg='sha1', dl_size=None,  # pylint: disable=too-many-positional-arguments, too-many-statements
+                  background=False, connections=1, mirrors=None):
+    """Makes HTTP request and displays a progress dialog on download.
+
+    With connections > 1 the file is fetched as concurrent byte ranges, provided the server advertises Accept-Ranges.
+    Interrupted downloads are kept in partial_path() and continue where they left off on the next call with the same url.
+    Mirrors are other URLs of the same file: the fastest one is downloaded from, switching to the others when it fails.
+    """
+    if checksum and hash_alg not in ('sha1', 'sha256', 'md5'):
+        log(4, 'Invalid hash algorithm specified: {}'.format(hash_alg))
+        checksum = None
+    if not checksum:
+        hash_alg = 'sha1'  # Still used to verify partial downloads before resuming them
+
+    urls = rank_mirrors([url] + [mirror for mirror in mirrors or [] if mirror != url])
+    req = _http_request(urls[0])
     if req is None:
         return None
 
@@ -156,62 +842,49 @@ def http_download(url, message=None, checksum=None, hash_alg='sha1', dl_size=Non
         log(2, 'The given file size does not match the request!')
         dl_size = total_length  # Otherwise size check at end would fail even if dl succeeded
 
+    remove_partials(keep_url=url, max_age=config.HTTP_DOWNLOAD_PARTIAL_MAX_AGE)
+    part_path, _ = _partial_download(url)
+    validator = req.info().get('etag') or req.info().get('last-modified')
+    state = _load_partial(url, total_length, validator)
+    if state is None or state.get('hash_alg') != hash_alg:
+        state = {'url': url, 'size': total_length, 'validator': validator, 'hash_alg': hash_alg, 'segments': [[0, total_length - 1]], 'digest': None}
+
     if background:
         progress = bg_progress_dialog()
     else:
         progress = progress_dialog()
     progress.create(localize(30014), message=message)  # Download in progress
 
-    starttime = time()
-    chunk_size = 32 * 1024
-    with open(compat_path(dl_path), 'wb') as image:
-        size = 0
-        while size < total_length:
-            try:
-                chunk = req.read(chunk_size)
-            except (timeout, SSLError):
-                req.close()
-                if not yesno_dialog(localize(30004), '{line1}\n{line2}'.format(line1=localize(30064),
-                                                                               line2=localize(30065))):  # Could not finish dl. Try again?
-                    progress.close()
-                    return False
-
-                headers = {'Range': 'bytes={}-{}'.format(size, total_length)}
-                req = _http_request(url, headers=headers)
-                if req is None:
-                    return None
-                continue
-
-            image.write(chunk)
-            if checksum:
-                calc_checksum.update(chunk)
-            size += len(chunk)
-            percent = int(round(size * 100 / total_length))
-            if not background and progress.iscanceled():
-                progress.close()
-                req.close()
-                return False
-            if time() - starttime > 5:
-                time_left = int(round((total_length - size) * (time() - starttime) / size))
-                prog_message = '{line1}\n{line2}'.format(
-                    line1=message,
-                    line2=localize(30058, mins=time_left // 60, secs=time_left % 60))  # Time remaining
-            else:
-                prog_message = message
-
-            progress.update(percent, prog_message)
+    result = None
+    stats = {}
+    if _accepts_ranges(req, total_length, connections):
+        req.close()
+        req = None
+        result = _http_download_ranges(urls, part_path, state, connections, progress, message, background, stats)
+        if result is None:  # Fall back to a single connection
+            state.update(segments=[[0, total_length - 1]], digest=None)
+    if result is None:
+        result = _http_download_stream(req, urls, part_path, state, progress, message, background, stats)
 
     progress.close()
-    req.close()
+    if len(urls) > 1:
+        for mirror, (num_of_bytes, seconds) in stats.items():
+            if num_of_bytes:
+                _save_mirror_speed(mirror, num_of_bytes / max(seconds, 0.001))
+    if not result:
+        return result
+
+    os.replace(compat_path(part_path), compat_path(dl_path))
+    _remove_partial(url)
 
-    checksum_ok = (not checksum or calc_checksum.hexdigest() == checksum)
+    checksum_ok = (not checksum or state['digest'] == checksum)
     size_ok = (not dl_size or stat_file(dl_path).st_size() == dl_size)
 
     if not all((checksum_ok, size_ok)):
         free_space = sizeof_fmt(diskspace())
         log(4, 'Something may be wrong with the downloaded file.')
         if not checksum_ok:
-            log(4, 'Provided checksum: {}\nCalculated checksum: {}'.format(checksum, calc_checksum.hexdigest()))
+            log(4, 'Provided checksum: {}\nCalculated checksum: {}'.format(checksum, state['digest']))
         if not size_ok:
             free_space = sizeof_fmt(diskspace())
             log(4, 'Expected filesize: {}\nReal filesize: {}\nRemaining diskspace: {}'.format(dl_size, stat_file(dl_path).st_size(), free_space))
@@ -378,6 +1051,45 @@ def elfbinary64(path):
         raise ValueError('Not a valid ELF class')
 
 
+def elfbinary_valid(path):
+    """Check that an ELF binary is an ARM shared library whose headers and segments fit within the file, e.g. it is not truncated"""
+    with open(compat_path(path), 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b'\x7fELF' or ident[4] not in (1, 2) or ident[5] not in (1, 2):
+            log(4, 'Invalid ELF identification in {path}', path=path)
+            return False
+        is_64bit = ident[4] == 2
+        endian = '<' if ident[5] == 1 else '>'
+        header_fmt = endian + ('2HI3QI6H' if is_64bit else '2H5I6H')
+        header = f.read(struct.calcsize(header_fmt))
+        if len(header) < struct.calcsize(header_fmt):
+            log(4, 'Truncated ELF header in {path}', path=path)
+            return False
+        e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum, e_shentsize, e_shnum, _ = struct.unpack(header_fmt, header)
+        size = os.fstat(f.fileno()).st_size
+
+        if e_type != 3 or e_machine not in (40, 183):  # ET_DYN, EM_ARM or EM_AARCH64
+            log(4, 'ELF binary {path} is not an ARM shared library (type {type}, machine {machine})', path=path, type=e_type, machine=e_machine)
+            return False
+        if e_phoff + e_phnum * e_phentsize > size or e_shoff + e_shnum * e_shentsize > size:
+            log(4, 'ELF header tables of {path} exceed its size of {size} bytes', path=path, size=size)
+            return False
+
+        phdr_fmt = endian + ('2I6Q' if is_64bit else '8I')
+        for num in range(e_phnum):
+            f.seek(e_phoff + num * e_phentsize)
+            phdr = struct.unpack(phdr_fmt, f.read(struct.calcsize(phdr_fmt)))
+            if is_64bit:
+                p_offset, p_filesz = phdr[2], phdr[5]
+            else:
+                p_offset, p_filesz = phdr[1], phdr[4]
+            if p_offset + p_filesz > size:
+                log(4, 'ELF segment {num} of {path} exceeds its size of {size} bytes', num=num, path=path, size=size)
+                return False
+
+    return True
+
+
 def hardlink(src, dest):
     """Hardlink a file when possible, copy when needed"""
     if exists(dest):
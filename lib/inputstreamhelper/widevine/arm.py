@@ -4,11 +4,14 @@
 
 import os
 import json
+import re
+from time import time
 
 from .. import config
-from ..kodiutils import browsesingle, localize, log, ok_dialog, open_file, progress_dialog, yesno_dialog
-from ..utils import diskspace, elfbinary64, http_download, http_get, parse_version, sizeof_fmt, system_os, update_temp_path, userspace64
-from .arm_chromeos import ChromeOSImage
+from ..kodiutils import (addon_profile, browsesingle, delete, exists, get_proxies, get_setting_bool, get_setting_int, listdir, localize, log, ok_dialog,
+                         open_file, progress_dialog, yesno_dialog)
+from ..utils import diskspace, elfbinary64, elfbinary_valid, http_download, http_stream, parse_version, sizeof_fmt, system_os, update_temp_path, userspace64
+from .arm_chromeos import ChromeOSError, ChromeOSImage, extract_files_in_worker
 
 
 def select_best_chromeos_image(devices):
@@ -59,9 +62,117 @@ def select_best_chromeos_image(devices):
     return best
 
 
+def parse_chromeos_devices(response, chunk_size=64 * 1024):
+    """
+    Parses the devices of a Chrome OS recovery configuration while it is being downloaded, keeping only the ARM devices
+
+    Only the undecoded tail of the download is held in memory, instead of the whole configuration and all of its devices.
+    """
+    from codecs import getincrementaldecoder
+    from gzip import GzipFile
+    arm_bnames = set(config.CHROMEOS_RECOVERY_ARM_BNAMES + config.CHROMEOS_RECOVERY_ARM64_BNAMES)
+    if response.info().get('content-encoding') == 'gzip':
+        response = GzipFile(fileobj=response)
+    text_decoder = getincrementaldecoder('utf-8')()
+    json_decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    devices = []
+    text = ''
+    in_list = False
+    while True:
+        data = response.read(chunk_size)
+        text += text_decoder.decode(data, final=not data)
+
+        pos = 0
+        while True:
+            pos = separators.match(text, pos).end()
+            if pos == len(text):
+                break
+            if not in_list:
+                if text[pos] != '[':
+                    raise ValueError('The Chrome OS recovery configuration is not a list')
+                in_list = True
+                pos += 1
+                continue
+            if text[pos] == ']':
+                return devices
+            try:
+                device, pos = json_decoder.raw_decode(text, pos)
+            except ValueError:  # Incomplete device, read on
+                break
+            file_parts = device.get('file', '').split('_') if isinstance(device, dict) else []
+            if len(file_parts) > 2 and file_parts[2] in arm_bnames:
+                devices.append(device)
+        text = text[pos:]
+        if not data:
+            raise ValueError('The Chrome OS recovery configuration ended unexpectedly')
+
+
+def chromeos_config_cache_path():
+    """Return the path to the cached Chrome OS recovery configuration"""
+    return os.path.join(addon_profile(), config.CHROMEOS_RECOVERY_CACHE_FILE)
+
+
+def load_chromeos_config_cache():
+    """Load the cached Chrome OS recovery configuration with its validators, or None"""
+    if not exists(chromeos_config_cache_path()):
+        return None
+    try:
+        with open_file(chromeos_config_cache_path(), 'r') as cache_file:
+            cache = json.loads(cache_file.read())
+    except ValueError as error:
+        log(3, 'Could not load the cached Chrome OS recovery configuration: {error}', error=error)
+        return None
+    if cache.get('url') != config.CHROMEOS_RECOVERY_URL:
+        return None
+    return cache
+
+
+def save_chromeos_config_cache(cache):
+    """Save the Chrome OS recovery configuration with its validators and the time it was last validated"""
+    cache.update(url=config.CHROMEOS_RECOVERY_URL, time=time())
+    with open_file(chromeos_config_cache_path(), 'w') as cache_file:
+        cache_file.write(json.dumps(cache))
+
+
 def chromeos_config():
-    """Reads the Chrome OS recovery configuration"""
-    return json.loads(http_get(config.CHROMEOS_RECOVERY_URL))
+    """
+    Reads the ARM devices from the Chrome OS recovery configuration
+
+    They are cached on disk. Within the TTL from the settings the cache is used as is, after that it is revalidated with
+    a conditional request, so an unchanged configuration is not downloaded again.
+    """
+    cache = load_chromeos_config_cache()
+    if cache and time() - cache['time'] < get_setting_int('recovery_cache_ttl', 24) * 3600:
+        log(0, 'Using the cached Chrome OS recovery configuration')
+        return cache['devices']
+
+    headers = {'Accept-Encoding': 'gzip'}
+    if cache and cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache and cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+    response = http_stream(config.CHROMEOS_RECOVERY_URL, headers=headers)
+    if response is None:
+        if cache:
+            log(2, 'Using the outdated cached Chrome OS recovery configuration')
+            return cache['devices']
+        return None
+
+    if response.getcode() == 304:
+        log(0, 'The cached Chrome OS recovery configuration is still up to date')
+        response.close()
+    else:
+        try:
+            devices = parse_chromeos_devices(response)
+        except ValueError as error:
+            log(4, 'Could not parse the Chrome OS recovery configuration: {error}', error=error)
+            return cache['devices'] if cache else None
+        finally:
+            response.close()
+        cache = {'etag': response.info().get('etag'), 'last_modified': response.info().get('last-modified'), 'devices': devices}
+    save_chromeos_config_cache(cache)
+    return cache['devices']
 
 
 def install_widevine_arm_chromeos(backup_path):
@@ -76,7 +187,9 @@ def install_widevine_arm_chromeos(backup_path):
         return False
 
     # Estimated required disk space: takes into account an extra 20 MiB buffer
-    required_diskspace = 20971520 + int(arm_device['zipfilesize'])
+    required_diskspace = 20971520
+    if not get_setting_bool('stream_extraction', False):  # The recovery image is stored on disk
+        required_diskspace += int(arm_device['zipfilesize'])
     if yesno_dialog(localize(30001),  # Due to distributing issues, this takes a long time
                     localize(30006, diskspace=sizeof_fmt(required_diskspace))):
         if system_os() != 'Linux':
@@ -109,49 +222,159 @@ def install_widevine_arm_chromeos(backup_path):
 def dl_extract_widevine_chromeos(url, backup_path, arm_device=None):
     """Download the ChromeOS image and extract Widevine from it"""
     if arm_device:
-        dl_path = http_download(url, message=localize(30022), checksum=arm_device['sha1'], hash_alg='sha1',
-                                dl_size=int(arm_device['zipfilesize']))  # Downloading the recovery image
+        checksum = arm_device['sha1']
         image_version = arm_device['version']
     else:
-        dl_path = http_download(url, message=localize(30022))
+        checksum = None
         image_version = os.path.basename(url).split('_')[1]
         # minimal info for config.json, "version" is definitely needed e.g. in load_widevine_config:
         arm_device = {"file": os.path.basename(url), "url": url, "version": image_version}
 
-    if dl_path:
-        progress = extract_widevine_chromeos(backup_path, dl_path, image_version)
-        if not progress:
+    if get_setting_bool('stream_extraction', False):
+        # Extract Widevine while downloading, without storing the recovery image. The download stops as soon as
+        # Widevine is extracted, so instead of the checksum of the image the extracted ELF binary is verified.
+        progress = extract_widevine_chromeos(backup_path, url, image_version, image_sha1=checksum)
+    else:
+        dl_path = http_download(url, message=localize(30022), checksum=checksum, hash_alg='sha1',
+                                dl_size=int(arm_device.get('zipfilesize', 0)), connections=config.HTTP_DOWNLOAD_CONNECTIONS)  # Downloading the recovery image
+        if not dl_path:
             return False
+        progress = extract_widevine_chromeos(backup_path, dl_path, image_version, image_sha1=checksum)
+
+    if not progress:
+        return False
 
-        config_file = os.path.join(backup_path, image_version, 'config.json')
-        with open_file(config_file, 'w') as conf_file:
-            conf_file.write(json.dumps(arm_device))
+    config_file = os.path.join(backup_path, image_version, 'config.json')
+    with open_file(config_file, 'w') as conf_file:
+        conf_file.write(json.dumps(arm_device))
 
-        return (progress, image_version)
+    return (progress, image_version)
+
+
+def chromeos_index_path():
+    """Return the path to the saved extraction indexes of Chrome OS images"""
+    return os.path.join(addon_profile(), config.CHROMEOS_INDEX_FILE)
+
+
+def load_chromeos_indexes():
+    """Load all saved extraction indexes, keyed by the sha1 of their Chrome OS image"""
+    if not exists(chromeos_index_path()):
+        return {}
+    try:
+        with open_file(chromeos_index_path(), 'r') as index_file:
+            return json.loads(index_file.read())
+    except ValueError as error:
+        log(3, 'Could not load Chrome OS extraction indexes: {error}', error=error)
+        return {}
 
-    return False
 
+def load_chromeos_index(image_path, image_sha1=None):
+    """
+    Return the saved extraction index of a Chrome OS image and its sha1, or (None, None)
 
-def extract_widevine_chromeos(backup_path, image_path, image_version):
-    """Extract Widevine from the given ChromeOS image"""
+    Without a sha1 (e.g. for manually selected images) the index is looked up by the file name of the image.
+    """
+    indexes = load_chromeos_indexes()
+    if image_sha1:
+        return indexes.get(image_sha1), image_sha1
+
+    def unzipped_name(path):
+        """The file name of the image inside a zipped image"""
+        name = os.path.basename(path)
+        return name[:-len('.zip')] if name.endswith('.zip') else name
+
+    for sha1, index in indexes.items():
+        if unzipped_name(index.get('file', '')) == unzipped_name(image_path):
+            return index, sha1
+    return None, None
+
+
+def save_chromeos_index(image_path, image_sha1, index):
+    """Save the extraction index of a Chrome OS image, or remove it if index is None"""
+    indexes = load_chromeos_indexes()
+    if index is None:
+        indexes.pop(image_sha1, None)
+    else:
+        index['file'] = os.path.basename(image_path)
+        indexes[image_sha1] = index
+    with open_file(chromeos_index_path(), 'w') as index_file:
+        index_file.write(json.dumps(indexes))
+
+
+def remove_chromeos_indexes(bpath=None):
+    """
+    Remove saved extraction indexes of Chrome OS images, all of them by default
+
+    With bpath, the indexes of image versions that no longer have a backup in bpath are removed.
+    """
+    if not exists(chromeos_index_path()):
+        return
+    if bpath is None:
+        delete(chromeos_index_path())
+        return
+
+    def image_version(index):
+        """The version in the file name of the image, e.g. 15886.44.0 of chromeos_15886.44.0_..._recovery_....bin"""
+        parts = os.path.basename(index.get('file', '')).split('_')
+        return parts[1] if len(parts) > 1 else None
+
+    indexes = load_chromeos_indexes()
+    versions = listdir(bpath)
+    kept = {sha1: index for sha1, index in indexes.items() if image_version(index) in versions}
+    if len(kept) < len(indexes):
+        log(0, 'Removing {num} extraction indexes of Chrome OS images without a backup', num=len(indexes) - len(kept))
+        with open_file(chromeos_index_path(), 'w') as index_file:
+            index_file.write(json.dumps(kept))
+
+
+def extract_widevine_chromeos(backup_path, image_path, image_version, image_sha1=None):
+    """
+    Extract Widevine from the given ChromeOS image, image_path can also be the URL of a zipped image
+
+    Where Widevine is found in the image is saved with the image's sha1, so extracting it again skips searching the image.
+    """
     progress = progress_dialog()
     progress.create(heading=localize(30043), message=localize(30044))  # Extracting Widevine CDM
 
     filename = config.WIDEVINE_CDM_FILENAME[system_os()]
     extract_path = os.path.join(backup_path, image_version)
 
-    extracted = ChromeOSImage(image_path, progress=progress).extract_file(
-        filename=filename,
-        extract_path=extract_path)
-
-    if extracted:
+    filenames = [filename] + config.CHROMEOS_WIDEVINE_EXTRA_FILES
+    index, index_sha1 = load_chromeos_index(image_path, image_sha1)
+    result = None
+    if get_setting_bool('worker_extraction', False):
+        result = extract_files_in_worker(image_path, filenames, extract_path, progress=progress, index=index, proxies=get_proxies())
+    if result is None:
+        try:
+            image = ChromeOSImage(image_path, progress=progress, index=index)
+            try:
+                extracted = image.extract_files(filenames=filenames, extract_path=extract_path)
+            finally:
+                image.close()  # Stops streaming the image, all blocks of the extracted files have been read
+        except ChromeOSError as error:
+            log(4, 'Extracting Widevine from the Chrome OS image failed with {error}', error=error)
+            progress.close()
+            return False
+        result = extracted, image.extraction_index()
+    extracted, extraction_index = result
+
+    if filename in extracted:
+        if not elfbinary_valid(os.path.join(extract_path, filename)):
+            log(4, 'The extracted Widevine CDM is not a valid ELF binary')
+            if index:  # The saved index is wrong
+                save_chromeos_index(image_path, index_sha1, None)
+            progress.close()
+            return False
         if not userspace64() == elfbinary64(os.path.join(extract_path, filename)):
             log(4, 'Widevine CDM userspace mismatch. Please check Chrome OS Recovery image userspace')
             progress.close()
             return False
-    else:
+    else:  # Canceled or aborted, a saved index is kept as it only ever holds the runs of a valid Widevine CDM
         log(4, 'Extracting widevine from the zip failed!')
         progress.close()
         return False
 
+    if image_sha1 and not index:
+        save_chromeos_index(image_path, image_sha1, extraction_index)
+
     return progress
@@ -2,36 +2,445 @@
 # MIT License (see LICENSE.txt or https://opensource.org/licenses/MIT)
 """Implements a class with methods related to the Chrome OS image"""
 
+import json
 import os
-from struct import calcsize, unpack
+import re
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack
+from functools import partial
+from struct import Struct, calcsize, unpack
+from sys import byteorder
 from zipfile import ZipFile
-from io import UnsupportedOperation
 
-from ..kodiutils import exists, localize, log, mkdirs
+from ..kodiutils import exists, localize, log, mkdirs, yesno_dialog
 from .. import config
 from ..unicodes import compat_path
+from ..utils import http_stream
+
+
+DirEntry = namedtuple('DirEntry', ('inode', 'rec_len', 'name_len', 'file_type', 'name'))
+DIR_ENTRY_HEADER = Struct('<IHBB')  # inode, rec_len, name_len, file_type
+
+
+def le_array(typecode, data):
+    """Returns an array of the unsigned little-endian integers (typecode 'H' or 'I') in data"""
+    values = array(typecode)
+    values.frombytes(data)
+    if byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def skip_stream(stream, num_of_bytes, chunksize=256 * 1024):
+    """Skips num_of_bytes of an unseekable stream by reading into one reused scratch buffer, returns the number of bytes skipped"""
+    scratch = memoryview(bytearray(min(chunksize, max(num_of_bytes, 1))))
+    skipped = 0
+    while skipped < num_of_bytes:
+        num_read = stream.readinto(scratch[:num_of_bytes - skipped])
+        if not num_read:
+            break
+        skipped += num_read
+    return skipped
 
 
 class ChromeOSError(Exception):
     """Custom Exception if something fails during extraction from ChromeOSImage"""
 
 
-class ChromeOSImage:
+class InflateStream:  # pylint: disable=too-many-instance-attributes
+    """
+    A file-like view on a member of a ZIP archive, inflated on the fly from a raw byte stream
+
+    The raw stream can be a local file or an HTTP response, so the archive never has to be stored on disk.
+    While inflating, the state of the decompressor is saved every few MiB (like zran from the zlib examples).
+    Seeking backwards resumes from the nearest of these checkpoints instead of inflating again from the start.
+    """
+
+    raw_chunksize = 256 * 1024
+
+    def __init__(self, opener, raw=None, start=0, raw_size=None, progress=None):
+        """
+        Parses the local file header of the archive member at raw byte offset start
+
+        opener(offset) must return a raw stream positioned at the given offset, raw can be an already opened one at start.
+        """
+        self.opener = opener
+        self.raw = None
+        self.raw_pos = start
+        self.raw_size = raw_size
+        self.progress = progress
+        self.percent = -1
+        self.scratch = memoryview(bytearray(self.raw_chunksize))  # reused for raw reads while inflating
+        if raw is None:
+            raw = opener(start)
+        self.raw = raw
+
+        header_fmt = '<4s5H3I2H'
+        signature, _, flags, method, _, _, _, compressed_size, _, fname_len, extra_len = unpack(header_fmt, self._read_raw(calcsize(header_fmt)))
+        if signature != b'PK\x03\x04':
+            raise ChromeOSError('Not a ZIP archive')
+        if flags & 0x1:
+            raise ChromeOSError('Encrypted ZIP archives are not supported')
+        self._read_raw(fname_len + extra_len)
+
+        self.data_start = self.raw_pos
+        self.pos = 0
+        if method == 8:  # deflate
+            self.decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == 0:  # stored
+            self.decomp = None
+            self.compressed_size = compressed_size
+        else:
+            raise ChromeOSError('Unsupported ZIP compression method {method}'.format(method=method))
+
+        # Checkpoints of the inflate state: positions in the inflated data, raw positions and decompressor copies
+        self.checkpoint_pos = [0]
+        self.checkpoints = [(self.raw_pos, self.decomp.copy() if self.decomp else None)]
+
+    def _open_raw(self, raw_pos):
+        """Reopen the raw stream at raw_pos"""
+        self.raw.close()
+        self.raw = self.opener(raw_pos)
+        self.raw_pos = raw_pos
+
+    def _retry_raw(self, read):
+        """
+        Call read(raw), reopening the raw stream at the current raw position when a download breaks off
+
+        A download breaks off when it ends before raw_size or a read fails. It is reopened a few times before asking to try again.
+        """
+        from http.client import HTTPException
+        retries = 0
+        while True:
+            try:
+                result = read(self.raw)
+                if result or not self.raw_size or self.raw_pos >= self.raw_size:
+                    return result
+                error = 'Connection closed at {pos} of {size} bytes'.format(pos=self.raw_pos, size=self.raw_size)
+            except (OSError, HTTPException) as exc:  # Includes timeouts and SSL errors
+                error = exc
+            log(2, 'Reading the ZIP archive failed with {error}', error=error)
+
+            retries += 1
+            if retries > config.CHROMEOS_INFLATE_RETRIES:
+                if not yesno_dialog(localize(30004), '{line1}\n{line2}'.format(line1=localize(30064),
+                                                                               line2=localize(30065))):  # Could not finish dl. Try again?
+                    raise ChromeOSError('Reading the ZIP archive failed with {error}'.format(error=error))
+                retries = 0
+            try:
+                self._open_raw(self.raw_pos)
+            except (OSError, HTTPException) as exc:
+                log(2, 'Reopening the ZIP archive at {pos} failed with {error}', pos=self.raw_pos, error=exc)
+
+    def _read_raw(self, num_of_bytes):
+        """Read from the raw stream, keeping track of its position and download progress"""
+        chunk = self._retry_raw(lambda raw: raw.read(num_of_bytes)) if num_of_bytes else b''
+        self._raw_read(len(chunk))
+        return chunk
+
+    def _read_raw_scratch(self):
+        """Read the next raw chunk into the scratch buffer, returns a view on the bytes read"""
+        num_of_bytes = self._retry_raw(lambda raw: raw.readinto(self.scratch))
+        self._raw_read(num_of_bytes)
+        return self.scratch[:num_of_bytes]
+
+    def _raw_read(self, num_of_bytes):
+        """Keep track of the raw stream position and download progress"""
+        self.raw_pos += num_of_bytes
+
+        if self.progress and self.raw_size:
+            percent = int(100 * self.raw_pos / self.raw_size)
+            if percent != self.percent:
+                self.percent = percent
+                self.progress.update(percent, localize(30022))  # Downloading the recovery image
+            if self.progress.iscanceled():
+                raise ChromeOSError('Download was canceled')
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) inflated bytes into buffer, returns the number of bytes read"""
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def read(self, num_of_bytes):
+        """Read and return up to num_of_bytes inflated bytes"""
+        if self.decomp is None:
+            chunk = self._read_raw(max(0, min(num_of_bytes, self.compressed_size - self.pos)))
+            self.pos += len(chunk)
+            return chunk
+
+        chunks = []
+        while num_of_bytes > 0 and not self.decomp.eof:
+            chunk = self._inflate(num_of_bytes)
+            num_of_bytes -= len(chunk)
+            chunks.append(chunk)
+
+        return b''.join(chunks)
+
+    def _inflate(self, max_length):
+        """Inflate and return the next chunk of at most max_length bytes"""
+        # The decompressor copies input it does not consume into unconsumed_tail, so the scratch buffer can be reused
+        data = self.decomp.unconsumed_tail or self._read_raw_scratch()
+        if not data:
+            raise ChromeOSError('Unexpected end of the ZIP archive')
+        chunk = self.decomp.decompress(data, max_length)
+        self.pos += len(chunk)
+
+        # All input consumed, so raw_pos is exactly where the decompressor continues
+        if not self.decomp.unconsumed_tail and self.pos >= self.checkpoint_pos[-1] + config.CHROMEOS_INFLATE_CHECKPOINT_INTERVAL:
+            self.checkpoint_pos.append(self.pos)
+            self.checkpoints.append((self.raw_pos, self.decomp.copy()))
+        return chunk
+
+    def seek(self, seek_pos):
+        """Move to seek_pos in the inflated data, resuming from the nearest checkpoint if that is quicker"""
+        if self.decomp is None:
+            self._open_raw(self.data_start + seek_pos)
+            self.pos = seek_pos
+            return seek_pos
+
+        from bisect import bisect_right
+        index = bisect_right(self.checkpoint_pos, seek_pos) - 1
+        if seek_pos < self.pos or self.checkpoint_pos[index] > self.pos:
+            raw_pos, decomp = self.checkpoints[index]
+            log(0, 'Resume inflating at checkpoint {pos} (raw position {raw_pos}) to reach {seek_pos}',
+                pos=self.checkpoint_pos[index], raw_pos=raw_pos, seek_pos=seek_pos)
+            self._open_raw(raw_pos)
+            self.decomp = decomp.copy()
+            self.pos = self.checkpoint_pos[index]
+
+        # Skip forward in small chunks that are dropped right away, instead of reading and joining large ones
+        while self.pos < seek_pos and not self.decomp.eof:
+            self._inflate(min(self.raw_chunksize, seek_pos - self.pos))
+        return self.pos
+
+    def tell(self):
+        """Return the position in the inflated data"""
+        return self.pos
+
+    def close(self):
+        """Close the raw stream, which stops a download that has not finished yet"""
+        if self.raw_size and self.raw_pos < self.raw_size:
+            log(0, 'Stopped reading the ZIP archive after {pos} of {size} bytes', pos=self.raw_pos, size=self.raw_size)
+        self.raw.close()
+
+
+class PipelinedStream:  # pylint: disable=too-many-instance-attributes
+    """
+    A file-like stream that reads ahead from another one in a producer thread, into a bounded queue of buffers
+
+    Used for zipped images, so inflating (zlib releases the GIL) and downloading overlap with parsing the image
+    and writing extracted files. Seeking forward drops buffered data, seeking backwards restarts the producer.
+    """
+
+    def __init__(self, stream, buffer_size, buffers):
+        """Starts reading ahead from the current position of stream"""
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffers = buffers
+        self.pos = stream.tell()
+        self.buffer = memoryview(b'')
+        self.offset = 0
+        self.eof = False
+        self.queue = None
+        self.stop = None
+        self.thread = None
+        self._start()
+
+    def _start(self):
+        """Start the producer thread"""
+        from queue import Queue
+        from threading import Event, Thread
+        self.queue = Queue(maxsize=self.buffers)
+        self.stop = Event()
+        self.thread = Thread(target=self._produce, args=(self.queue, self.stop), name='InflateAhead')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, queue, stop):
+        """Producer thread: reads buffers into the queue until the end of the stream, errors are passed on to the consumer"""
+        try:
+            while not stop.is_set():
+                chunk = self.stream.read(self.buffer_size)
+                self._put(queue, stop, chunk)
+                if not chunk:
+                    return
+        except Exception as error:  # pylint: disable=broad-except
+            self._put(queue, stop, error)
+
+    @staticmethod
+    def _put(queue, stop, item):
+        """Put an item in the queue, waiting while it is full unless the producer is stopped"""
+        from queue import Full
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _stop(self):
+        """Stop the producer thread and drop all buffered data"""
+        self.stop.set()
+        self.thread.join()
+        self.buffer = memoryview(b'')
+        self.offset = 0
+
+    def _next_buffer(self):
+        """Move on to the next buffer from the queue, returns False at the end of the stream"""
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            self.eof = True
+            raise item
+        self.buffer = memoryview(item)
+        self.offset = 0
+        self.eof = not item
+        return not self.eof
+
+    def _advance(self, num_of_bytes):
+        """Return a view on up to num_of_bytes of the current buffer and move past them, None at the end of the stream"""
+        if self.offset == len(self.buffer) and (self.eof or not self._next_buffer()):
+            return None
+        chunk = self.buffer[self.offset:self.offset + num_of_bytes]
+        self.offset += len(chunk)
+        self.pos += len(chunk)
+        return chunk
+
+    def read(self, num_of_bytes):
+        """Read and return up to num_of_bytes bytes"""
+        chunks = []
+        while num_of_bytes > 0:
+            chunk = self._advance(num_of_bytes)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            num_of_bytes -= len(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) bytes into buffer, returns the number of bytes read"""
+        num_of_bytes = 0
+        while num_of_bytes < len(buffer):
+            chunk = self._advance(len(buffer) - num_of_bytes)
+            if chunk is None:
+                break
+            buffer[num_of_bytes:num_of_bytes + len(chunk)] = chunk
+            num_of_bytes += len(chunk)
+        return num_of_bytes
+
+    def seek(self, seek_pos):
+        """Move to seek_pos, dropping buffered data when moving forward and restarting the producer when moving backwards"""
+        if seek_pos >= self.pos:
+            while self.pos < seek_pos and self._advance(seek_pos - self.pos) is not None:
+                pass
+            return self.pos
+
+        self._stop()
+        self.pos = self.stream.seek(seek_pos)
+        self.eof = False
+        self._start()
+        return self.pos
+
+    def tell(self):
+        """Return the position in the stream"""
+        return self.pos
+
+    def close(self):
+        """Stop the producer thread and close the stream"""
+        self._stop()
+        self.stream.close()
+
+
+class MmapStream:
+    """
+    A file-like, read-only view on a memory-mapped local image
+
+    Reads return memoryview slices of the mapping, so parsing the image does not copy it into new bytes objects.
+    """
+
+    def __init__(self, path):
+        """Maps the whole file, raises OSError if it cannot be mapped (e.g. a large image on a 32-bit system)"""
+        import mmap
+        with open(compat_path(path), 'rb') as opened_file:
+            self.mmap = mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.pos = 0
+
+    def read(self, num_of_bytes):
+        """Return up to num_of_bytes as a memoryview slice"""
+        chunk = self.view[self.pos:self.pos + num_of_bytes]
+        self.pos += len(chunk)
+        return chunk
+
+    def seek(self, seek_pos):
+        """Move to seek_pos"""
+        self.pos = seek_pos
+        return seek_pos
+
+    def tell(self):
+        """Return the position in the image"""
+        return self.pos
+
+    def close(self):
+        """Unmap the image, unless slices of it are still in use, then it is unmapped when they are released"""
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+
+class ChromeOSImage:  # pylint: disable=too-many-instance-attributes
     """
     The main class handling a Chrome OS image
 
     Information related to ext2 is sourced from here: https://www.nongnu.org/ext2-doc/ext2.html
     """
 
-    def __init__(self, imgpath, progress=None):
-        """Prepares the image"""
+    def __init__(self, imgpath, progress=None, index=None):
+        """
+        Prepares the image
+
+        imgpath can also be the URL of a zipped image, which is then extracted while it is being downloaded.
+        Closing the image stops such a download, so only the blocks needed for extraction are transferred.
+
+        index is what extraction_index() returned for an earlier extraction of the same image. With it,
+        extract_files() skips the GPT, superblock and directory work and reads the saved block runs directly.
+        """
         self.progress = progress
         if self.progress:
             self.progress.update(2, localize(30060))
         self.imgpath = imgpath
         self.bstream = self._get_bstream(imgpath)
-        self.part_offset = self.chromeos_offset()
-        self.blocksize = None
+        try:
+            self._prepare(index)
+        except Exception:
+            self.bstream[0].close()  # also stops reading ahead
+            raise
+
+    def _prepare(self, index):
+        """Reads the partition table and filesystem information, unless they are known from the index"""
+        self.block_cache = OrderedDict()  # block number -> data, least recently used first
+        self.block_cache_hits = 0
+        self.block_cache_misses = 0
+        self.index = index
+        self.extracted = {}  # filename -> inode number, size and block runs of extracted files, None if not found
+        if index:
+            self.part_offset = index['part_offset']
+            self.blocksize = index['blocksize']
+            self.sb_dict = None
+            self.blk_groups = None
+        else:
+            self.part_offset = self.chromeos_offset()
+            self.blocksize = None
+            self._read_filesystem()
+        self.dcache = {}  # inode number -> parsed directory entries
+        self.path_inodes = {(): 2}  # path -> inode number, the root directory is inode 2
+
+    def _read_filesystem(self):
+        """Reads the superblock and block group descriptors of the ext2 filesystem"""
         self.sb_dict = self._superblock()
         self.blk_groups = self._block_groups()
 
@@ -83,104 +492,191 @@ class ChromeOSImage:
         if bfname in chunk:
             i_index_pos = chunk.index(bfname) - 8  # the filename is the last element of the dentry, the elements before are 8 bytes total
             file_entry = self.dir_entry(chunk[i_index_pos:i_index_pos + len(bfname) + 8])  # 8 because see above
-            if file_entry['inode'] < self.sb_dict['s_inodes_count'] and file_entry['name_len'] == len(bfname):
+            if file_entry.inode < self.sb_dict['s_inodes_count'] and file_entry.name_len == len(bfname):
                 return file_entry
 
             log(0, 'Found filename, but checks did not pass:')
-            log(0, 'inode number: {inode} < {count}, name_len: {name_len} == {len_fname}'.format(inode=file_entry['inode'],
+            log(0, 'inode number: {inode} < {count}, name_len: {name_len} == {len_fname}'.format(inode=file_entry.inode,
                                                                                                  count=self.sb_dict['s_inodes_count'],
-                                                                                                 name_len=file_entry['name_len'],
+                                                                                                 name_len=file_entry.name_len,
                                                                                                  len_fname=len(bfname)))
         return False
 
-    def _find_file_naive(self, fname):
+    def _scan_stream(self, pattern, max_len):
         """
-        Finds a file by basically searching for the filename as bytes in the bytestream.
-        Searches through the whole image only once, making it fast, but may be unreliable at times.
+        Scans the rest of the bytestream for a regular expression in a single pass, reusing one buffer.
+        Only a small tail of each chunk is kept, so matches across chunk borders are found too.
 
-        Returns a directory entry.
+        Yields every match as its position and the match including the 8 bytes in front of it, where a dentry would start.
         """
+        stream = self.bstream[0]
+        if isinstance(stream, MmapStream):  # search the mapped image in place
+            num_of_workers = config.CHROMEOS_SCAN_PROCESSES or os.cpu_count() or 1
+            if num_of_workers > 1 and len(stream.mmap) - self.bstream[1] >= config.CHROMEOS_PARALLEL_SCAN_MIN_SIZE and worker_command():
+                positions = self._scan_parallel(pattern, max_len, num_of_workers)
+            else:
+                positions = (match.start() for match in pattern.finditer(stream.mmap, self.bstream[1]))
+            for position in positions:
+                yield position, stream.mmap[position - 8:pattern.match(stream.mmap, position).end()]
+            return
 
-        fname_alt = fname + '#new'  # Sometimes the filename has "#new" at the end
-        bfname = fname.encode('ascii')
-        bfname_alt = fname_alt.encode('ascii')
-        chunksize = 4 * 1024**2
-        chunk1 = self.read_stream(chunksize)
+        overlap = max_len + 8 - 1
+        buf = bytearray(overlap + 4 * 1024**2)
+        view = memoryview(buf)
+        buf_pos = self.bstream[1]  # position of buf[0] in the bytestream
+        keep = 0
         while True:
-            chunk2 = self.read_stream(chunksize)
-            if not chunk2:
-                raise ChromeOSError('File {fname} not found in the ChromeOS image'.format(fname=fname))
+            num_of_bytes = self.readinto_stream(view[keep:])
+            if not num_of_bytes:
+                return
+            end = keep + num_of_bytes
 
-            chunk = chunk1 + chunk2
+            for match in pattern.finditer(buf, 0, end):
+                if match.end() <= keep or match.start() < 8:  # already reported with the previous chunk
+                    continue
+                yield buf_pos + match.start(), bytes(buf[match.start() - 8:match.end()])
 
-            file_entry = self._find_file_in_chunk(bfname, chunk)
-            if file_entry:
-                break
+            keep = min(overlap, end)
+            buf[:keep] = buf[end - keep:end]
+            buf_pos += end - keep
 
-            file_entry = self._find_file_in_chunk(bfname_alt, chunk)
+    def _scan_parallel(self, pattern, max_len, num_of_workers):
+        """
+        Scans the rest of the mapped image for a regular expression with several low priority processes, each searching one region.
+        The regions overlap by the length of the longest match, so matches across their borders are found too.
+
+        Yields the positions of all matches in order. Regions that could not be scanned by another process are scanned here,
+        and the processes still scanning are stopped when the caller stops early.
+        """
+        from subprocess import PIPE, Popen
+        mapped = self.bstream[0].mmap
+        start = self.bstream[1]
+        region_size = -(-(len(mapped) - start) // num_of_workers)
+        regions = [(region_start, min(region_start + region_size, len(mapped))) for region_start in range(start, len(mapped), region_size)]
+        workers = []
+        try:
+            for region_start, region_end in regions:
+                job = {'task': 'scan', 'image_path': self.imgpath, 'pattern': pattern.pattern.decode('latin-1'),
+                       'start': region_start, 'end': region_end, 'max_len': max_len, 'niceness': config.CHROMEOS_WORKER_NICENESS}
+                try:
+                    worker = Popen(worker_command(), stdin=PIPE, stdout=PIPE)  # pylint: disable=consider-using-with
+                    worker.stdin.write(json.dumps(job).encode('utf-8'))
+                    worker.stdin.close()
+                except OSError as error:
+                    log(3, 'Starting a scanning process failed with {error}', error=error)
+                    worker = None
+                workers.append(worker)
+            log(0, 'Scanning the Chrome OS image in {num} processes', num=len([worker for worker in workers if worker]))
+
+            for (region_start, region_end), worker in zip(regions, workers):
+                positions = None
+                if worker:
+                    output = worker.stdout.read()
+                    if worker.wait() == 0:
+                        positions = json.loads(output.decode('utf-8'))['matches']
+                if positions is None:
+                    log(3, 'Scanning {start}-{end} of the Chrome OS image in another process failed, scanning it here', start=region_start, end=region_end)
+                    end = min(region_end + max_len - 1, len(mapped))
+                    positions = [match.start() for match in pattern.finditer(mapped, region_start, end) if match.start() < region_end]
+                yield from positions
+        finally:
+            for worker in workers:
+                if worker:
+                    if worker.poll() is None:
+                        worker.kill()
+                        worker.wait()
+                    worker.stdout.close()
+
+    def _find_files_naive(self, fnames):
+        """
+        Finds files by basically searching for their filenames as bytes in the bytestream.
+        Searches through the image only once for all files, making it fast, but may be unreliable at times.
+
+        Returns a dict of directory entries with the filenames as key, files that were not found are left out.
+        """
+        bfnames = []
+        for fname in fnames:
+            bfnames += [fname.encode('ascii') + b'#new', fname.encode('ascii')]  # Sometimes the filename has "#new" at the end
+        bfnames.sort(key=len, reverse=True)  # longest first, the regex prefers the first alternative
+        pattern = re.compile(b'|'.join(re.escape(bfname) for bfname in bfnames))
+
+        file_entries = {}
+        for _, chunk in self._scan_stream(pattern, len(bfnames[0])):
+            fname = chunk[8:].decode('ascii')
+            if fname.endswith('#new'):
+                fname = fname[:-len('#new')]
+            if fname in file_entries:
+                continue
+
+            file_entry = self._find_file_in_chunk(chunk[8:], chunk)
             if file_entry:
-                break
+                file_entries[fname] = file_entry
+                if len(file_entries) == len(fnames):
+                    break
+
+        return file_entries
 
-            chunk1 = chunk2
+    def _find_file_naive(self, fname):
+        """
+        Finds a file by basically searching for the filename as bytes in the bytestream.
+        Searches through the whole image only once, making it fast, but may be unreliable at times.
+
+        Returns a directory entry.
+        """
+        file_entries = self._find_files_naive([fname])
+        if fname not in file_entries:
+            raise ChromeOSError('File {fname} not found in the ChromeOS image'.format(fname=fname))
 
-        return file_entry
+        return file_entries[fname]
 
     def _find_file_properly(self, filename, path_to_file=("opt", "google", "chrome", "WidevineCdm", "_platform_specific", "cros_arm64")):
         """
         Finds a file at a given path, or searches upwards if not found.
 
         Assumes the path is roughly correct, else it might take long.
-        It also might take long for ZIP files, since it might have to jump back and forth while traversing down the given path.
+        The directories are looked up with a read plan, so ZIP files are inflated in a few forward passes
+        instead of jumping back and forth while traversing down the given path.
 
         Returns a directory entry.
         """
-        root_inode_pos = self._calc_inode_pos(2)
-        root_inode_dict = self._inode_table(root_inode_pos)
-        root_dir_entries = self.dir_entries(self.read_file(self._get_block_ids(root_inode_dict)))
+        found = {}
+
+        def search_dir(dentries):
+            """Looks for the file in a directory, or plans searching its subdirectories"""
+            if 'entry' in found:
+                return []
+            if filename in dentries:
+                found['entry'] = dentries[filename]
+                return []
+
+            requests = []
+            for name, dentry in dentries.items():
+                if name in (".", "..") or not dentry.file_type == 2:  # makes sure it's not recursive and checks if a directory
+                    continue
+                requests += self._plan_dir(dentry.inode, search_dir)
+            return requests
 
-        dentries = root_dir_entries
-        try:
-            for dir_name in path_to_file:
-                inode_dict = self._inode_table(self._calc_inode_pos(dentries[dir_name]["inode"]))
-                dentries = self.dir_entries(self.read_file(self._get_block_ids(inode_dict)))
+        def enter_dir(inode_num):
+            if inode_num is None:
+                found['missing'] = True
+                return []
+            return self._plan_dir(inode_num, search_dir)
 
-        except KeyError:
+        self._run_plan(self._plan_lookup(path_to_file, enter_dir), until=lambda: 'entry' in found)
+
+        if 'entry' in found:
+            return found['entry']
+
+        if 'missing' in found:
             log(0, "Path to {filename} does not exist: {path}".format(filename=filename, path=path_to_file))
             return self.find_file(filename, path_to_file[:-1])
 
-        file_entry = self._find_file_in_dir(filename, dentries)
-        if file_entry:
-            return file_entry
-
         log(0, "{filename} not found in path: {path}".format(filename=filename, path=path_to_file))
         if path_to_file:
             return self.find_file(filename, path_to_file[:-1])
 
         return None
 
-    def _find_file_in_dir(self, filename, dentries):
-        """
-        Finds a file in a directory or recursively in its subdirectories.
-        Can take long for deep searches.
-
-        Returns the first result as a directory entry.
-        """
-        try:
-            return dentries[filename]
-        except KeyError:
-            for dentry in dentries:
-                if dentry in (".", "..") or not dentries[dentry]["file_type"] == 2:  # makes sure it's not recursive and checks if a directory
-                    continue
-
-                inode_dict = self._inode_table(self._calc_inode_pos(dentries[dentry]["inode"]))
-                subdentries = self.dir_entries(self.read_file(self._get_block_ids(inode_dict)))
-
-                file_entry = self._find_file_in_dir(filename, subdentries)
-                if file_entry:
-                    return file_entry
-
-            return None
-
     def find_file(self, filename, path_to_file=None):
         """
         Finds a file. Supplying a path could take longer for ZIP files!
@@ -201,10 +697,9 @@ class ChromeOSImage:
     def _calc_inode_pos(self, inode_num):
         """Calculate the byte position of an inode from its index"""
         blk_group_num = (inode_num - 1) // self.sb_dict['s_inodes_per_group']
-        blk_group = self.blk_groups[blk_group_num]
         i_index_in_group = (inode_num - 1) % self.sb_dict['s_inodes_per_group']
 
-        return self.part_offset + self.blocksize * blk_group['bg_inode_table'] + self.sb_dict['s_inode_size'] * i_index_in_group
+        return self.part_offset + self.blocksize * self.blk_groups['bg_inode_table'][blk_group_num] + self.sb_dict['s_inode_size'] * i_index_in_group
 
     def _superblock(self):
         """Get relevant info from the superblock, assert it's an ext2 fs"""
@@ -213,8 +708,9 @@ class ChromeOSImage:
                  's_mnt_count', 's_max_mnt_count', 's_magic', 's_state', 's_errors', 's_minor_rev_level', 's_lastcheck', 's_checkinterval',
                  's_creator_os', 's_rev_level', 's_def_resuid', 's_def_resgid', 's_first_ino', 's_inode_size', 's_block_group_nr',
                  's_feature_compat', 's_feature_incompat', 's_feature_ro_compat', 's_uuid', 's_volume_name', 's_last_mounted',
-                 's_algorithm_usage_bitmap', 's_prealloc_block', 's_prealloc_dir_blocks')
-        fmt = '<13I6H4I2HI2H3I16s16s64sI2B818x'
+                 's_algorithm_usage_bitmap', 's_prealloc_block', 's_prealloc_dir_blocks', 's_reserved_gdt_blocks', 's_journal_uuid',
+                 's_journal_inum', 's_journal_dev', 's_last_orphan', 's_hash_seed', 's_def_hash_version', 's_jnl_backup_type', 's_desc_size')
+        fmt = '<13I6H4I2HI2H3I16s16s64sI2BH16s3I16s2BH768x'
         fmt_len = calcsize(fmt)
 
         self.seek_stream(self.part_offset + 1024)  # superblock starts after 1024 byte
@@ -238,220 +734,604 @@ class ChromeOSImage:
 
         return sb_dict
 
-    def _block_group(self):
-        """Get info about a block group. Expects stream to be at the right position already."""
-        names = ('bg_block_bitmap', 'bg_inode_bitmap', 'bg_inode_table', 'bg_free_blocks_count', 'bg_free_inodes_count', 'bg_used_dirs_count', 'bg_pad')
-        fmt = '<3I4H12x'
-        fmt_len = calcsize(fmt)
-
-        pack = self.read_stream(fmt_len)
-        blk = unpack(fmt, pack)
-
-        blk_dict = dict(list(zip(names, blk)))
-
-        return blk_dict
-
     def _block_groups(self):
-        """Get info about all block groups"""
+        """
+        Get info about all block groups, read with one bulk read of the descriptor table.
+
+        Returns a dict of arrays (one per descriptor field) indexed by block group number.
+        """
         if self.blocksize == 1024:
             self.seek_stream(self.part_offset + 2 * self.blocksize)
         else:
             self.seek_stream(self.part_offset + self.blocksize)
 
-        blk_groups = []
-        for _ in range(self.sb_dict['block_groups_count']):
-            blk_group = self._block_group()
-            blk_groups.append(blk_group)
-
+        # Block group descriptor: bg_block_bitmap, bg_inode_bitmap, bg_inode_table (32 bit), bg_free_blocks_count,
+        #                         bg_free_inodes_count, bg_used_dirs_count, bg_pad (16 bit), 12 reserved bytes
+        # With the 64bit feature of ext4, descriptors are s_desc_size bytes long and hold the high 32 bits of the block numbers at 32
+        desc_size = 32
+        if self.sb_dict['s_feature_incompat'] & 0x80 and self.sb_dict['s_desc_size']:  # INCOMPAT_64BIT
+            desc_size = self.sb_dict['s_desc_size']
+        table = self.read_stream(desc_size * self.sb_dict['block_groups_count'])
+        words = le_array('I', table)
+        halves = le_array('H', table)
+        step = desc_size // 4
+
+        blk_groups = {
+            'bg_block_bitmap': words[0::step],
+            'bg_inode_bitmap': words[1::step],
+            'bg_inode_table': words[2::step],
+            'bg_free_blocks_count': halves[6::2 * step],
+            'bg_free_inodes_count': halves[7::2 * step],
+            'bg_used_dirs_count': halves[8::2 * step],
+        }
+        if desc_size >= 64:
+            for name, highs in (('bg_block_bitmap', words[8::step]), ('bg_inode_bitmap', words[9::step]), ('bg_inode_table', words[10::step])):
+                blk_groups[name] = [low | high << 32 for low, high in zip(blk_groups[name], highs)]
         return blk_groups
 
     def _inode_table(self, inode_pos):
         """Reads and returns an inode table entry and its size"""
+        block_id, offset = divmod(inode_pos - self.part_offset, self.blocksize)
+        return self._parse_inode(self._read_block(block_id)[offset:offset + self.sb_dict['s_inode_size']])
+
+    def _parse_inode(self, pack):
+        """Parses an inode table entry into a dict"""
         names = ('i_mode', 'i_uid', 'i_size', 'i_atime', 'i_ctime', 'i_mtime', 'i_dtime', 'i_gid', 'i_links_count', 'i_blocks', 'i_flags',
                  'i_osd1', 'i_block0', 'i_block1', 'i_block2', 'i_block3', 'i_block4', 'i_block5', 'i_block6', 'i_block7', 'i_block8',
                  'i_block9', 'i_block10', 'i_block11', 'i_blocki', 'i_blockii', 'i_blockiii', 'i_generation', 'i_file_acl', 'i_dir_acl', 'i_faddr')
         fmt = '<2Hi4I2H3I15I4I12x'
         fmt_len = calcsize(fmt)
-        inode_size = self.sb_dict['s_inode_size']
 
-        self.seek_stream(inode_pos)
-        pack = self.read_stream(fmt_len)
-        inode = unpack(fmt, pack)
+        inode = unpack(fmt, pack[:fmt_len])
 
         inode_dict = dict(list(zip(names, inode)))
         inode_dict['i_mode'] = hex(inode_dict['i_mode'])
+        inode_dict['i_block_data'] = pack[40:100]  # raw i_block array, the root of the extent tree for ext4 extents
 
         blocks = inode_dict['i_size'] / self.blocksize
         inode_dict['blocks'] = int(blocks) if float(int(blocks)) == blocks else int(blocks) + 1
 
-        self.read_stream(inode_size - fmt_len)  # move to end of entry
         return inode_dict
 
     @staticmethod
-    def dir_entry(chunk):
-        """Returns the directory entry found in chunk as dict."""
-        dir_names = ('inode', 'rec_len', 'name_len', 'file_type', 'name')
-        dir_fmt = '<IHBB' + str(len(chunk) - 8) + 's'
+    def dir_entry(chunk, offset=0):
+        """Returns the directory entry found in chunk at offset as DirEntry."""
+        inode, rec_len, name_len, file_type = DIR_ENTRY_HEADER.unpack_from(chunk, offset)
+        name = bytes(chunk[offset + DIR_ENTRY_HEADER.size:offset + DIR_ENTRY_HEADER.size + name_len])
 
-        entry = dict(list(zip(dir_names, unpack(dir_fmt, chunk))))
-        entry["name"] = entry["name"][:entry["name_len"]]
-
-        return entry
+        return DirEntry(inode, rec_len, name_len, file_type, name)
 
     def dir_entries(self, dir_file):
-        """Returns all directory entries of a directory file as dict of dicts with name as key"""
+        """Returns all directory entries of a directory file as dict of DirEntry with name as key"""
         dirs = {}
-        while dir_file:
-            dir_entry = self.dir_entry(dir_file)
-            dir_file = dir_file[dir_entry["rec_len"]:]
-            if dir_entry['inode'] == 0:
+        dir_view = memoryview(dir_file)
+        offset = 0
+        while offset + DIR_ENTRY_HEADER.size <= len(dir_view):
+            dir_entry = self.dir_entry(dir_view, offset)
+            if dir_entry.rec_len == 0:
+                raise ChromeOSError('Invalid directory entry with a record length of 0')
+            offset += dir_entry.rec_len
+            if dir_entry.inode == 0:
                 continue
 
-            name = dir_entry["name"].decode()
+            name = dir_entry.name.decode()
             dirs[name] = dir_entry
 
         return dirs
 
-    def _iblock_ids(self, blk_id, ids_to_read):
-        """Reads the block indices/IDs from an indirect block"""
-        seek_pos = self.part_offset + self.blocksize * blk_id
-        self.seek_stream(seek_pos)
-        fmt = '<' + str(int(self.blocksize / 4)) + 'I'
-        ids = list(unpack(fmt, self.read_stream(self.blocksize)))
-        ids_to_read -= len(ids)
-
-        return ids, ids_to_read
-
-    def _iiblock_ids(self, blk_id, ids_to_read):
-        """Reads the block indices/IDs from a doubly-indirect block"""
-        seek_pos = self.part_offset + self.blocksize * blk_id
-        self.seek_stream(seek_pos)
-        fmt = '<' + str(int(self.blocksize / 4)) + 'I'
-        iids = unpack(fmt, self.read_stream(self.blocksize))
-
-        ids = []
-        for iid in iids:
-            if ids_to_read <= 0:
-                break
-            ind_block_ids, ids_to_read = self._iblock_ids(iid, ids_to_read)
-            ids += ind_block_ids
+    def seek_stream(self, seek_pos):
+        """Move position of bstream to seek_pos, all streams from _get_bstream can seek"""
+        self.bstream[0].seek(seek_pos)
+        self.bstream[1] = seek_pos
 
-        return ids, ids_to_read
+    def read_stream(self, num_of_bytes):
+        """Read and return a chunk of the bytestream"""
+        self.bstream[1] += num_of_bytes
 
-    def seek_stream(self, seek_pos):
-        """Move position of bstream to seek_pos"""
-        try:
-            self.bstream[0].seek(seek_pos)
-            self.bstream[1] = seek_pos
-            return
+        return self.bstream[0].read(num_of_bytes)
+
+    def readinto_stream(self, buffer):
+        """Read a chunk of the bytestream into buffer, returns the number of bytes read"""
+        num_of_bytes = self.bstream[0].readinto(buffer)
+        self.bstream[1] += num_of_bytes
 
-        except UnsupportedOperation:
-            chunksize = 4 * 1024**2
+        return num_of_bytes
 
-            if seek_pos >= self.bstream[1]:
-                while seek_pos - self.bstream[1] > chunksize:
-                    self.read_stream(chunksize)
-                self.read_stream(seek_pos - self.bstream[1])
-                return
+    def _read_block(self, block_id):
+        """Reads a block of the partition, the last config.CHROMEOS_BLOCK_CACHE_SIZE blocks read are cached"""
+        if block_id in self.block_cache:
+            self.block_cache_hits += 1
+            self.block_cache.move_to_end(block_id)
+            return self.block_cache[block_id]
 
-            self.bstream[0].close()
-            self.bstream[1] = 0
-            self.bstream = self._get_bstream(self.imgpath)
+        self.block_cache_misses += 1
+        self.seek_stream(self.part_offset + self.blocksize * block_id)
+        block = self.read_stream(self.blocksize)
+        self.block_cache[block_id] = block
+        if len(self.block_cache) > config.CHROMEOS_BLOCK_CACHE_SIZE:
+            self.block_cache.popitem(last=False)
+        return block
 
-            while seek_pos - self.bstream[1] > chunksize:
-                self.read_stream(chunksize)
-            self.read_stream(seek_pos - self.bstream[1])
+    def _run_plan(self, requests, until=None):
+        """
+        Executes a read plan, a list of (block_id, num_blocks, callback) requests for runs of consecutive blocks.
 
-            return
+        The runs are read in ascending order, so the stream only ever moves forward. Every callback gets the data
+        of its run and returns new requests, which typically are only known after reading that run (e.g. the data
+        blocks listed in an indirect block). New requests ahead of the current position join the running pass, those
+        behind it are deferred to another forward pass, unless they are single blocks found in the block cache.
+        Stops early once until() returns True.
+        """
+        from heapq import heapify, heappop, heappush
+        pending = [(block_id, seq, num_blocks, callback) for seq, (block_id, num_blocks, callback) in enumerate(requests)]
+        seq = len(pending)
+        heapify(pending)
+        passes = 0
+        while pending:
+            passes += 1
+            deferred = []
+            last_start, last_end, last_data = -1, -1, b''
+            while pending:
+                if until and until():
+                    return
+                block_id, _, num_blocks, callback = heappop(pending)
+                if last_start <= block_id and block_id + num_blocks <= last_end:  # e.g. another inode in the same block
+                    offset = self.blocksize * (block_id - last_start)
+                    data = last_data[offset:offset + self.blocksize * num_blocks]
+                elif num_blocks == 1 and block_id in self.block_cache:
+                    data = self._read_block(block_id)
+                elif block_id < last_end:
+                    deferred.append((block_id, seq, num_blocks, callback))
+                    seq += 1
+                    continue
+                elif num_blocks == 1:  # metadata like inodes, indirect blocks and directories
+                    data = self._read_block(block_id)
+                    last_start, last_end, last_data = block_id, block_id + 1, data
+                else:
+                    self.seek_stream(self.part_offset + self.blocksize * block_id)
+                    data = self.read_stream(self.blocksize * num_blocks)
+                    last_start, last_end, last_data = block_id, block_id + num_blocks, data
+                for new_id, new_num_blocks, new_callback in callback(data):
+                    heappush(pending, (new_id, seq, new_num_blocks, new_callback))
+                    seq += 1
+            pending = deferred
+            heapify(pending)
+            if pending:
+                log(0, 'Read plan needs another pass for {num} runs', num=len(pending))
+        log(0, 'Read plan finished in {passes} forward pass(es)', passes=passes)
+
+    def _plan_inode(self, inode_num, callback):
+        """Plans reading an inode table entry, callback gets the inode dict"""
+        block_id, offset = divmod(self._calc_inode_pos(inode_num) - self.part_offset, self.blocksize)
+        inode_size = self.sb_dict['s_inode_size']
+        return [(block_id, 1, lambda data: callback(self._parse_inode(data[offset:offset + inode_size])))]
 
-    def read_stream(self, num_of_bytes):
-        """Read and return a chunk of the bytestream"""
-        self.bstream[1] += num_of_bytes
+    def _plan_file(self, inode_dict, callback, runs=None):
+        """
+        Plans reading all blocks of a file (can be directory or anything ext2 considers a file), including the
+        indirect blocks or ext4 extent tree nodes that map them. The blocks are read in runs of at most
+        config.CHROMEOS_MAX_EXTENT_SIZE bytes, callback gets the index of the first block in the file and the run's data.
 
-        return self.bstream[0].read(num_of_bytes)
+        The runs are also appended to the runs list as [index, block_id, num_blocks], if given.
+        """
+        blocks = inode_dict['blocks']
+        ids_per_block = self.blocksize // 4
+        max_blocks = max(1, config.CHROMEOS_MAX_EXTENT_SIZE // self.blocksize)
+
+        def read_extent(index):
+            return lambda data: callback(index, data)
+
+        def plan_run(index, block_id, num_blocks):
+            """Plans reading num_blocks consecutive blocks starting at block_id, block_id 0 being a hole"""
+            requests = []
+            num_blocks = min(num_blocks, blocks - index)
+            for offset in range(0, num_blocks, max_blocks):
+                length = min(max_blocks, num_blocks - offset)
+                if runs is not None:
+                    runs.append([index + offset, block_id and block_id + offset, length])
+                if block_id == 0:  # hole in a sparse file
+                    requests += callback(index + offset, bytes(self.blocksize * length))
+                else:
+                    requests.append((block_id + offset, length, read_extent(index + offset)))
+            return requests
+
+        def read_indirect(level, index):
+            return lambda data: plan_blocks(level - 1, index, le_array('I', data))
+
+        def plan_blocks(level, index, block_ids):
+            """Plans reading data blocks (level 0) or the indirect blocks mapping the blocks from index on"""
+            span = ids_per_block ** level
+            requests = []
+            run = []  # [first index, first block id, number of blocks]
+            for num, block_id in enumerate(block_ids):
+                block_index = index + num * span
+                if block_index >= blocks:
+                    break
+
+                if level > 0:
+                    if block_id == 0:
+                        requests += plan_run(block_index, 0, span)
+                    else:
+                        requests.append((block_id, 1, read_indirect(level, block_index)))
+                elif run and block_id == (run[1] and run[1] + run[2]):  # continues the run of blocks or of holes
+                    run[2] += 1
+                else:
+                    if run:
+                        requests += plan_run(*run)
+                    run = [block_index, block_id, 1]
+
+            if run:
+                requests += plan_run(*run)
+            return requests
+
+        def read_extent_node(data):
+            return self._plan_extent_node(data, plan_run, read_extent_node)
+
+        if inode_dict['i_flags'] & 0x80000:  # EXT4_EXTENTS_FL, i_block holds the root of an extent tree
+            return self._plan_extent_node(inode_dict['i_block_data'], plan_run, read_extent_node)
+
+        requests = plan_blocks(0, 0, [inode_dict['i_block' + str(i)] for i in range(12)])
+        requests += plan_blocks(1, 12, [inode_dict['i_blocki']])
+        requests += plan_blocks(2, 12 + ids_per_block, [inode_dict['i_blockii']])
+        requests += plan_blocks(3, 12 + ids_per_block + ids_per_block**2, [inode_dict['i_blockiii']])
+
+        return requests
 
-    def _get_block_ids(self, inode_dict):
-        """Get all block indices/IDs of an inode"""
-        if not inode_dict['i_blockiii'] == 0:
-            raise ChromeOSError("Triply indirect blocks detected, but not implemented!")
+    @staticmethod
+    def _plan_extent_node(node, plan_run, read_extent_node):
+        """
+        Plans reading the runs of an ext4 extent tree node, see https://www.kernel.org/doc/html/latest/filesystems/ext4/dynamic.html#extent-tree
 
-        ids_to_read = inode_dict['blocks']
-        block_ids = [inode_dict['i_block' + str(i)] for i in range(12)]
-        ids_to_read -= 12
+        Leaf entries are passed on to plan_run(index, start_block, num_blocks), index nodes are read with read_extent_node.
+        """
+        magic, entries, _, depth = unpack('<4H', node[:8])
+        if magic != 0xf30a:
+            raise ChromeOSError('Invalid extent tree node')
+
+        requests = []
+        for num in range(entries):
+            entry = node[12 + 12 * num:24 + 12 * num]
+            if depth == 0:
+                # Leaf entry: ee_block, ee_len, ee_start_hi, ee_start_lo
+                index, length, start_hi, start_lo = unpack('<I2HI', entry)
+                if length > 32768:  # uninitialized extent, reads as zeros
+                    requests += plan_run(index, 0, length - 32768)
+                else:
+                    requests += plan_run(index, start_hi << 32 | start_lo, length)
+            else:
+                # Index entry: ei_block, ei_leaf_lo, ei_leaf_hi
+                _, leaf_lo, leaf_hi = unpack('<2IH2x', entry)
+                requests.append((leaf_hi << 32 | leaf_lo, 1, read_extent_node))
+
+        return requests
+
+    def _plan_runs(self, runs, callback):
+        """Plans reading runs of blocks saved by _plan_file, callback gets the index of the first block in the file and the run's data"""
+        requests = []
+        for index, block_id, num_blocks in runs:
+            if block_id == 0:  # hole in a sparse file
+                requests += callback(index, bytes(self.blocksize * num_blocks))
+            else:
+                requests.append((block_id, num_blocks, lambda data, index=index: callback(index, data)))
+        return requests
+
+    def _plan_dir(self, inode_num, callback):
+        """
+        Plans reading a directory, callback gets its directory entries once all of its blocks are read.
+        Parsed directories are kept in the dcache, so each directory is only read once.
+        """
+        if inode_num in self.dcache:
+            return callback(self.dcache[inode_num])
 
-        if not inode_dict['i_blocki'] == 0:
-            iblocks, ids_to_read = self._iblock_ids(inode_dict['i_blocki'], ids_to_read)
-            block_ids += iblocks
-        if not inode_dict['i_blockii'] == 0:
-            iiblocks, ids_to_read = self._iiblock_ids(inode_dict['i_blockii'], ids_to_read)
-            block_ids += iiblocks
+        def read_dir(inode_dict):
+            extents = {}
 
-        return block_ids[:inode_dict['blocks']]
+            def collect(index, data):
+                extents[index] = data
+                if sum(len(extent) for extent in extents.values()) < self.blocksize * inode_dict['blocks']:
+                    return []
+                self.dcache[inode_num] = self.dir_entries(b''.join(extents[i] for i in sorted(extents)))
+                return callback(self.dcache[inode_num])
 
-    def _read_file_dict(self, block_ids):
-        """Reads blocks specified by IDs into a dict with IDs as key"""
-        block_dict = {}
-        for block_id in block_ids:
-            if self.progress:
-                percent = int(35 + 60 * block_ids.index(block_id) / len(block_ids))
-                self.progress.update(percent, localize(30048))
-            seek_pos = self.part_offset + self.blocksize * block_id
-            self.seek_stream(seek_pos)
-            block_dict[block_id] = self.read_stream(self.blocksize)
+            return self._plan_file(inode_dict, collect)
+
+        return self._plan_inode(inode_num, read_dir)
+
+    def _plan_lookup(self, path, callback):
+        """
+        Plans resolving a path (a sequence of names) to its inode number, callback gets None if the path does not exist.
+        Starts from the longest part of the path that was resolved before.
+        """
+        path = tuple(path)
+        depth = len(path)
+        while path[:depth] not in self.path_inodes:
+            depth -= 1
 
-        return block_dict
+        def enter(depth, inode_num):
+            if depth == len(path):
+                return callback(inode_num)
 
-    def read_file(self, block_ids):
-        """Reads a file (can be directory or anything ext2 considers a file) as one binary string"""
-        block_ids_sorted = sorted(block_ids)
-        block_dict = self._read_file_dict(block_ids_sorted)
+            def read_dir(dentries):
+                if path[depth] not in dentries or (depth + 1 < len(path) and not dentries[path[depth]].file_type == 2):
+                    return callback(None)
+                self.path_inodes[path[:depth + 1]] = dentries[path[depth]].inode
+                return enter(depth + 1, dentries[path[depth]].inode)
 
-        file_str = b''
-        for block_id in block_ids:
-            file_str += block_dict[block_id]
+            return self._plan_dir(inode_num, read_dir)
 
-        return file_str
+        return enter(depth, self.path_inodes[path[:depth]])
+
+    def lookup(self, path):
+        """
+        Resolves a path in the image, given as '/' separated string or as sequence of names.
+
+        Returns its inode number, or None if it does not exist.
+        """
+        if isinstance(path, str):
+            path = [name for name in path.split('/') if name]
+
+        result = []
+
+        def found(inode_num):
+            result.append(inode_num)
+            return []
+
+        self._run_plan(self._plan_lookup(path, found))
+        return result[0]
 
     def write_file(self, inode_dict, filepath):
         """Writes file specified by its inode to filepath"""
-        bytes_to_write = inode_dict['i_size']
-        block_ids = self._get_block_ids(inode_dict)
-        bin_file = self.read_file(block_ids)[:bytes_to_write]
+        self.write_files([(inode_dict, filepath)])
+
+    def write_files(self, targets):
+        """Writes files specified by a list of (inode dict, filepath) tuples, reading the blocks of all files in one read plan"""
+        self._write_targets([(filepath, inode_dict['i_size'], partial(self._plan_file, inode_dict)) for inode_dict, filepath in targets])
+
+    def _write_targets(self, targets):
+        """
+        Writes files specified by a list of (filepath, size, plan) tuples in one read plan.
+        plan(callback) returns the requests for the blocks of the file, see _plan_file.
+        """
+        total = sum(size for _, size, _ in targets)
+        written = 0
+
+        def writer(opened_file, bytes_to_write):
+            """Returns a callback that writes the extents of a file"""
+            def write_extent(index, data):
+                nonlocal written
+                pos = index * self.blocksize
+                opened_file.seek(pos)
+                opened_file.write(data[:bytes_to_write - pos])
+                written += min(len(data), bytes_to_write - pos)
+                if self.progress:
+                    self.progress.update(int(35 + 60 * written / total), localize(30048))
+                return []
+            return write_extent
+
+        with ExitStack() as stack:
+            requests = []
+            opened_files = []
+            for filepath, size, plan in targets:
+                write_dir = os.path.join(os.path.dirname(filepath), '')
+                if not exists(write_dir):
+                    mkdirs(write_dir)
+                opened_file = stack.enter_context(open(compat_path(filepath), 'wb'))
+                opened_files.append(opened_file)
+                requests += plan(writer(opened_file, size))
+
+            self._run_plan(requests)
+            for (_, size, _), opened_file in zip(targets, opened_files):
+                opened_file.truncate(size)  # in case the file ends with a hole
 
-        write_dir = os.path.join(os.path.dirname(filepath), '')
-        if not exists(write_dir):
-            mkdirs(write_dir)
+    @staticmethod
+    def _open_url(url, offset=0):
+        """Open a download of url at a byte offset"""
+        req = http_stream(url, headers={'Range': 'bytes={}-'.format(offset)} if offset else None)
+        if req is None:
+            raise ChromeOSError('Could not download {url}'.format(url=url))
 
-        with open(compat_path(filepath), 'wb') as opened_file:
-            opened_file.write(bin_file)
+        if offset and req.getcode() != 206:  # Server ignored the Range header, skip to offset
+            if skip_stream(req, offset) < offset:
+                raise ChromeOSError('Unexpected end of download {url}'.format(url=url))
+        return req
 
     @staticmethod
-    def _get_bstream(imgpath):
+    def _open_file(path, offset=0):
+        """Open a local file at a byte offset"""
+        opened_file = open(compat_path(path), 'rb')  # pylint: disable=consider-using-with
+        opened_file.seek(offset)
+        return opened_file
+
+    def _get_bstream(self, imgpath):
         """Get a bytestream of the image"""
-        if imgpath.endswith('.zip'):
-            bstream = ZipFile(compat_path(imgpath), 'r').open(os.path.basename(imgpath).strip('.zip'), 'r')  # pylint: disable=consider-using-with
+        if imgpath.startswith(('http://', 'https://')):
+            req = self._open_url(imgpath)
+            raw_size = int(req.info().get('content-length', 0))
+            bstream = InflateStream(lambda offset: self._open_url(imgpath, offset), raw=req, raw_size=raw_size, progress=self.progress)
+        elif imgpath.endswith('.zip'):
+            with ZipFile(compat_path(imgpath), 'r') as zip_obj:
+                header_offset = zip_obj.getinfo(os.path.basename(imgpath).strip('.zip')).header_offset
+            bstream = InflateStream(lambda offset: self._open_file(imgpath, offset), start=header_offset)
         else:
-            bstream = open(compat_path(imgpath), 'rb')  # pylint: disable=consider-using-with
-
+            try:
+                bstream = MmapStream(imgpath)
+            except (OSError, ValueError) as error:
+                log(2, 'Could not memory-map {path}: {error}', path=imgpath, error=error)
+                bstream = open(compat_path(imgpath), 'rb')  # pylint: disable=consider-using-with
+            return [bstream, 0]
+
+        if config.CHROMEOS_INFLATE_AHEAD_BUFFERS:
+            bstream = PipelinedStream(bstream, config.CHROMEOS_INFLATE_AHEAD_BUFFER_SIZE, config.CHROMEOS_INFLATE_AHEAD_BUFFERS)
         return [bstream, 0]
 
+    def close(self):
+        """Closes the bytestream of the image, this also stops downloading a streamed image"""
+        log(0, 'Block cache: {hits} hits, {misses} misses', hits=self.block_cache_hits, misses=self.block_cache_misses)
+        self.block_cache.clear()
+        self.bstream[0].close()
+
     def extract_file(self, filename, extract_path):
         """Extracts the file from the image"""
+        return filename in self.extract_files([filename], extract_path)
+
+    def extract_files(self, filenames, extract_path):
+        """
+        Extracts several files from the image in one go. Filenames are searched for, all of them in one scan of the image,
+        while paths ('/' separated) are looked up from the root directory. The data of all files is read in one read plan.
+
+        Returns the list of extracted filenames, files that were not found are logged and left out.
+        """
+
+        if self.index and all(filename in self.index['files'] for filename in filenames):
+            try:
+                return self._extract_indexed(filenames, extract_path)
+            except ChromeOSError as error:
+                log(3, 'Extracting with the saved index failed with {error}, searching the image instead', error=error)
+        if self.sb_dict is None:
+            self._read_filesystem()
 
         try:
             if self.progress:
                 self.progress.update(5, localize(30061))
-            file_entry = self.find_file(filename)
+            names = [filename for filename in filenames if '/' not in filename]
+            file_entries = self._find_files_naive(names) if names else {}
+
+            inodes = {}
+            for filename in filenames:
+                if '/' in filename:
+                    inodes[filename] = self.lookup(filename)
+                    continue
+                if filename not in file_entries:
+                    if self.progress:
+                        self.progress.update(5, localize(30071))  # Could not find file, doing proper search
+                    file_entries[filename] = self._find_file_properly(filename)
+                inodes[filename] = file_entries[filename].inode if file_entries[filename] else None
+
+            for filename in [filename for filename in filenames if inodes[filename] is None]:
+                log(3, '{filename} not found in the Chrome OS image', filename=filename)
+                del inodes[filename]
+                self.extracted[filename] = None
 
             if self.progress:
                 self.progress.update(32, localize(30062))
-            inode_pos = self._calc_inode_pos(file_entry["inode"])
-            inode_dict = self._inode_table(inode_pos)
+            inode_dicts = {}
 
-            self.write_file(inode_dict, os.path.join(extract_path, filename))
+            def store(filename):
+                def store_inode(inode_dict):
+                    inode_dicts[filename] = inode_dict
+                    return []
+                return store_inode
 
-            return True
+            requests = []
+            for filename, inode_num in inodes.items():
+                requests += self._plan_inode(inode_num, store(filename))
+            self._run_plan(requests)
+
+            targets = []
+            for filename, inode_num in inodes.items():
+                runs = []
+                self.extracted[filename] = {'inode': inode_num, 'size': inode_dicts[filename]['i_size'], 'runs': runs}
+                targets.append((os.path.join(extract_path, os.path.basename(filename)), inode_dicts[filename]['i_size'],
+                                partial(self._plan_file, inode_dicts[filename], runs=runs)))
+            self._write_targets(targets)
+
+            return list(inodes)
 
         except ChromeOSError as error:
-            log(4, "Extracting {filename} failed with {error}!".format(filename=filename, error=error))
-            return False
+            log(4, "Extracting {filenames} failed with {error}!".format(filenames=filenames, error=error))
+            return []
+
+    def _extract_indexed(self, filenames, extract_path):
+        """Extracts files by reading the block runs saved in the index"""
+        if self.progress:
+            self.progress.update(32, localize(30062))
+        targets = []
+        for filename in filenames:
+            self.extracted[filename] = self.index['files'][filename]
+            if self.extracted[filename]:
+                targets.append((os.path.join(extract_path, os.path.basename(filename)), self.extracted[filename]['size'],
+                                partial(self._plan_runs, self.extracted[filename]['runs'])))
+        log(0, 'Extracting {filenames} using the saved index', filenames=filenames)
+        self._write_targets(targets)
+
+        return [filename for filename in filenames if self.extracted[filename]]
+
+    def extraction_index(self):
+        """
+        Returns the partition offset, block size and the inode numbers, sizes and block runs of the extracted files,
+        which can be saved to extract the same files from the same image again without searching it
+        """
+        return {'part_offset': self.part_offset, 'blocksize': self.blocksize, 'files': self.extracted}
+
+
+def worker_command():
+    """
+    Returns the command to start a chromeos_worker process with, or None if there is no Python interpreter to run it
+
+    The process gets the idle I/O scheduling class where ionice is available, it lowers its CPU priority itself.
+    """
+    from shutil import which
+    python = which(config.CHROMEOS_WORKER_PYTHON)
+    if not python:
+        return None
+    command = [python, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chromeos_worker.py')]
+    if which('ionice'):
+        command = ['ionice', '-c', '3'] + command  # Idle I/O scheduling class
+    return command
+
+
+def extract_files_in_worker(imgpath, filenames, extract_path, progress=None, index=None, proxies=None):  # pylint: disable=too-many-positional-arguments
+    """
+    Extracts files from the image like ChromeOSImage.extract_files, but in a separate Python process with the lowest CPU
+    and I/O priority, so that searching and inflating the image does not make Kodi stutter.
+
+    Returns the extracted filenames and the extraction index, or None when the worker process could not do the extraction.
+    """
+    from select import select
+    from subprocess import PIPE, Popen
+    command = worker_command()
+    if not command:
+        log(2, 'Python interpreter {python} not found, extracting the Chrome OS image in Kodi', python=config.CHROMEOS_WORKER_PYTHON)
+        return None
+
+    job = {'task': 'extract', 'image_path': imgpath, 'filenames': filenames, 'extract_path': extract_path, 'index': index, 'proxies': proxies,
+           'niceness': config.CHROMEOS_WORKER_NICENESS}
+    log(0, 'Extracting {filenames} in a separate process: {command}', filenames=filenames, command=command)
+
+    result = None
+    try:
+        worker = Popen(command, stdin=PIPE, stdout=PIPE)  # pylint: disable=consider-using-with
+        worker.stdin.write(json.dumps(job).encode('utf-8'))
+        worker.stdin.close()
+    except OSError as error:
+        log(2, 'Starting the extraction process failed with {error}, extracting the Chrome OS image in Kodi', error=error)
+        return None
+    try:
+        while True:
+            if progress and progress.iscanceled():
+                log(4, 'Extracting {filenames} was canceled!', filenames=filenames)
+                return [], None
+            if not select([worker.stdout], [], [], 0.2)[0]:
+                continue
+            line = worker.stdout.readline()
+            if not line:
+                break
+            message = json.loads(line.decode('utf-8'))
+            if 'progress' in message:
+                if progress:
+                    progress.update(message['progress'][0], localize(message['progress'][1]))
+            elif 'log' in message:
+                log(*message['log'])
+            elif 'error' in message:
+                log(4, 'The extraction process failed with {error}', error=message['error'])
+            else:
+                result = message['extracted'], message['index']
+    finally:
+        if worker.poll() is None:
+            worker.kill()
+        worker.wait()
+        worker.stdout.close()
+
+    if result is None:
+        log(4, 'The extraction process exited with code {code}, extracting the Chrome OS image in Kodi', code=worker.returncode)
+    return result
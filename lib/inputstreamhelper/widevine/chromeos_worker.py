@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# MIT License (see LICENSE.txt or https://opensource.org/licenses/MIT)
+"""
+Extracts files from a Chrome OS image, or scans a region of it, in a separate Python process started by arm_chromeos
+
+The Kodi modules are not available outside of Kodi, so the few functions arm_chromeos uses from kodiutils and utils
+are replaced by ones that report back over stdout, one JSON message per line.
+"""
+
+import json
+import mmap
+import os
+import re
+import sys
+from importlib import import_module
+from types import ModuleType
+
+
+def send(**message):
+    """Send a message to Kodi as one line of JSON"""
+    sys.stdout.write(json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+
+def log(level=0, message='', **kwargs):
+    """Send log messages to Kodi"""
+    if kwargs:
+        message = message.format(**kwargs)
+    send(log=[level, message])
+
+
+def localize(string_id, **kwargs):  # pylint: disable=unused-argument
+    """Return the string id as is, Kodi localizes the progress messages"""
+    return string_id
+
+
+def yesno_dialog(heading='', message=''):  # pylint: disable=unused-argument
+    """Dialogs cannot be shown from this process, so a broken off download is not tried again"""
+    return False
+
+
+def mkdirs(path):
+    """Create directory including parents"""
+    os.makedirs(path, exist_ok=True)
+
+
+def http_stream(url, headers=None):
+    """Perform an HTTP GET request and return the response, to be read as a stream"""
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+    log(0, 'Request URL: {url}', url=url)
+    try:
+        return urlopen(Request(url, headers=headers or {}), timeout=10)
+    except (HTTPError, URLError) as err:
+        log(2, 'Download failed with error {}'.format(err))
+        return None
+
+
+class Progress:
+    """Forwards progress updates to the progress dialog in Kodi, which stops this process when the dialog is canceled"""
+
+    @staticmethod
+    def update(percent, message=None):
+        """Send a progress update"""
+        send(progress=[percent, message])
+
+    @staticmethod
+    def iscanceled():
+        """Canceling is handled by Kodi"""
+        return False
+
+
+def import_arm_chromeos():
+    """Import arm_chromeos without importing the inputstreamhelper package, which needs Kodi"""
+    widevine_path = os.path.dirname(os.path.abspath(__file__))
+    for name, path in (('inputstreamhelper', os.path.dirname(widevine_path)), ('inputstreamhelper.widevine', widevine_path)):
+        package = ModuleType(name)
+        package.__path__ = [path]
+        sys.modules[name] = package
+
+    kodiutils = ModuleType('inputstreamhelper.kodiutils')
+    kodiutils.exists = os.path.exists
+    kodiutils.localize = localize
+    kodiutils.log = log
+    kodiutils.mkdirs = mkdirs
+    kodiutils.yesno_dialog = yesno_dialog
+    sys.modules['inputstreamhelper.kodiutils'] = kodiutils
+
+    utils = ModuleType('inputstreamhelper.utils')
+    utils.http_stream = http_stream
+    sys.modules['inputstreamhelper.utils'] = utils
+
+    return import_module('inputstreamhelper.widevine.arm_chromeos')
+
+
+def scan(job):
+    """Search one region of the image for a regular expression, and send the positions of the matches back"""
+    os.nice(job['niceness'])
+    pattern = re.compile(job['pattern'].encode('latin-1'))
+    with open(job['image_path'], 'rb') as image, mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        end = min(job['end'] + job['max_len'] - 1, len(mapped))  # matches starting in this region may end in the next one
+        send(matches=[match.start() for match in pattern.finditer(mapped, job['start'], end) if match.start() < job['end']])
+
+
+def extract(job):
+    """Extract the files of the job, and send the extracted files and the extraction index back"""
+    os.nice(job['niceness'])
+    if job['proxies']:
+        from urllib.request import build_opener, install_opener, ProxyHandler
+        install_opener(build_opener(ProxyHandler(job['proxies'])))
+
+    arm_chromeos = import_arm_chromeos()
+    try:
+        image = arm_chromeos.ChromeOSImage(job['image_path'], progress=Progress(), index=job['index'])
+        try:
+            extracted = image.extract_files(filenames=job['filenames'], extract_path=job['extract_path'])
+        finally:
+            image.close()
+    except arm_chromeos.ChromeOSError as error:
+        send(error=str(error))
+        return
+    send(extracted=extracted, index=image.extraction_index())
+
+
+def main():
+    """Run the job read from stdin"""
+    job = json.load(sys.stdin)
+    if job['task'] == 'scan':
+        scan(job)
+    else:
+        extract(job)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@
 """Implements functions specific to systems where the widevine library is available from Google's repository"""
 
 import json
-import random
 
 from ..utils import arch, http_post, system_os
 
@@ -53,5 +52,6 @@ def latest_widevine_available_from_repo(cdm_os, cdm_arch):
     cdm_json = json.loads(text)
     cdm['version'] = cdm_json.get('response').get('apps')[0].get('updatecheck').get('nextversion')
     cdm_urls = cdm_json.get('response').get('apps')[0].get('updatecheck').get('pipelines')[0].get('operations')[0].get('urls')
-    cdm['url'] = random.choice(cdm_urls).get('url')
+    cdm['url'] = cdm_urls[0].get('url')  # Identifies a partial download across restarts, http_download picks the fastest mirror
+    cdm['mirrors'] = [cdm_url.get('url') for cdm_url in cdm_urls]
     return cdm
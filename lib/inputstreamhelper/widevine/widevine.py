@@ -41,7 +41,7 @@ def widevine_eula():
 
     cdm = latest_widevine_available_from_repo(cdm_os, cdm_arch)
 
-    dl_path = http_download(cdm.get('url'), message=localize(30025), background=True)  # Acquiring EULA
+    dl_path = http_download(cdm.get('url'), message=localize(30025), background=True, mirrors=cdm.get('mirrors'))  # Acquiring EULA
     if not dl_path:
         return False
 
@@ -197,4 +197,7 @@ def remove_old_backups(bpath):
         remove_version = str(v)
         log(2, 'Removing old backup: {version}', version=remove_version)
         remove_tree(os.path.join(bpath, remove_version, ''))  # ensure trailing separator
+    if to_remove:
+        from .arm import remove_chromeos_indexes
+        remove_chromeos_indexes(bpath)
     return
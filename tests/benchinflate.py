@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# MIT License (see LICENSE.txt or https://opensource.org/licenses/MIT)
+"""
+Measure the memory used to skip forward in zipped Chrome OS images, run with: python -m tests.benchinflate [size in MiB]
+
+A zipped test image is generated in a temporary directory, no download is needed. For every way of skipping forward,
+the peak of the traced memory is reported, as well as the total size of all bytes objects created while skipping.
+Memory that is freed right away does not raise the peak, but allocating and copying it still costs time.
+"""
+
+import os
+import sys
+import tracemalloc
+import zlib
+from tempfile import TemporaryDirectory
+from time import time
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from inputstreamhelper.widevine.arm_chromeos import InflateStream, skip_stream
+
+MIB = 1024 * 1024
+SEEK_STEP = 8 * MIB  # Like seeking from one file of the image to the next
+OLD_READ_SIZE = 4 * MIB  # Skipping by reading and dropping chunks, like seek_stream did before
+
+
+ALLOCATED = {'total': 0}  # Size of the bytes objects returned by the decompressors and raw streams
+
+
+def count(data):
+    """Count the size of a new bytes object and return it"""
+    ALLOCATED['total'] += len(data)
+    return data
+
+
+class CountingDecompressor:
+    """Wraps a zlib decompressor, counting the inflated bytes it returns"""
+
+    def __init__(self, decomp):
+        self.decomp = decomp
+
+    def decompress(self, data, max_length=0):
+        """Inflate data like zlib does"""
+        return count(self.decomp.decompress(data, max_length))
+
+    def copy(self):
+        """Copy the decompressor state, counting the output of the copy as well"""
+        return CountingDecompressor(self.decomp.copy())
+
+    def __getattr__(self, name):
+        """Pass eof, unconsumed_tail etc. on from the zlib decompressor"""
+        return getattr(self.decomp, name)
+
+
+class CountingFile:
+    """Wraps a raw file, counting the bytes returned by read(), readinto() uses the caller's buffer"""
+
+    def __init__(self, path, offset=0):
+        self.raw = open(path, 'rb', buffering=0)  # pylint: disable=consider-using-with
+        self.raw.seek(offset)
+
+    def read(self, num_of_bytes):
+        """Read and return a new bytes object"""
+        return count(self.raw.read(num_of_bytes))
+
+    def readinto(self, buffer):
+        """Read into the given buffer"""
+        return self.raw.readinto(buffer)
+
+    def close(self):
+        """Close the file"""
+        self.raw.close()
+
+
+def create_image(path, size):
+    """Write a zipped image of size bytes that compresses to about a quarter, like a Chrome OS image"""
+    member = os.path.basename(path)[:-len('.zip')]
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zip_obj, zip_obj.open(member, 'w', force_zip64=True) as image:
+        for _ in range(size // MIB):
+            image.write((os.urandom(64 * 1024) + bytes(192 * 1024)) * 4)
+    with ZipFile(path) as zip_obj:
+        return zip_obj.getinfo(member).header_offset
+
+
+def open_stream(path, offset):
+    """Open an InflateStream on the zipped image whose decompressors count their output"""
+    stream = InflateStream(lambda raw_pos: CountingFile(path, raw_pos), start=offset)
+    stream.decomp = CountingDecompressor(stream.decomp)
+    stream.checkpoints = [(raw_pos, CountingDecompressor(decomp)) for raw_pos, decomp in stream.checkpoints]
+    return stream
+
+
+def skip_by_seeking(path, offset, size):
+    """Skip forward with InflateStream.seek(), which inflates into short-lived chunks of at most 256 KiB"""
+    stream = open_stream(path, offset)
+    for pos in range(SEEK_STEP, size, SEEK_STEP):
+        stream.seek(pos)
+    stream.close()
+
+
+def skip_by_reading(path, offset, size):
+    """Skip forward by reading and dropping large chunks"""
+    stream = open_stream(path, offset)
+    while stream.tell() < size:
+        count(stream.read(OLD_READ_SIZE))
+    stream.close()
+
+
+def skip_raw_stream(path, offset, size):
+    """Skip the raw (deflated) bytes of the image with skip_stream(), which reads into one reused scratch buffer"""
+    raw = CountingFile(path, offset)
+    skip_stream(raw, size)
+    raw.close()
+
+
+def skip_raw_reading(path, offset, size):
+    """Skip the raw (deflated) bytes of the image by reading and dropping large chunks"""
+    raw = CountingFile(path, offset)
+    while size > 0:
+        size -= len(raw.read(min(OLD_READ_SIZE, size)))
+    raw.close()
+
+
+def measure(name, func, *args):
+    """Run func while tracing memory, and print its peak, the total size of its bytes objects and its duration"""
+    ALLOCATED['total'] = 0
+    tracemalloc.start()
+    starttime = time()
+    func(*args)
+    duration = time() - starttime
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{name:<24} peak {peak:6.1f} MiB   allocated {total:8.1f} MiB   {duration:.2f} s'.format(
+        name=name, peak=peak / MIB, total=ALLOCATED['total'] / MIB, duration=duration))
+
+
+def run():
+    """Main function"""
+    size = int(sys.argv[1]) * MIB if len(sys.argv) > 1 else 100 * MIB
+    with TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'chromeos_bench_recovery.bin.zip')
+        offset = create_image(path, size)
+        raw_size = os.path.getsize(path) - offset
+        print('Skipping through {size} MiB inflated, {raw_size:.1f} MiB deflated (zlib {version})'.format(
+            size=size // MIB, raw_size=raw_size / MIB, version=zlib.ZLIB_RUNTIME_VERSION))
+        measure('InflateStream.seek', skip_by_seeking, path, offset, size)
+        measure('InflateStream.read', skip_by_reading, path, offset, size)
+        measure('skip_stream', skip_raw_stream, path, offset, raw_size)
+        measure('raw read', skip_raw_reading, path, offset, raw_size)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v3.0 (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# pylint: disable=missing-docstring
+
+import gzip
+import json
+import os
+import struct
+import subprocess
+import unittest
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from threading import Thread
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from inputstreamhelper import config, utils
+from inputstreamhelper.kodiutils import get_setting, set_setting
+from inputstreamhelper.utils import elfbinary_valid, http_session
+from inputstreamhelper.widevine.arm import (chromeos_config, chromeos_config_cache_path, chromeos_index_path, load_chromeos_config_cache, load_chromeos_index,
+                                            load_chromeos_indexes, parse_chromeos_devices, remove_chromeos_indexes, save_chromeos_index)
+from inputstreamhelper.widevine.arm_chromeos import ChromeOSError, ChromeOSImage, PipelinedStream
+
+CDM_DIR = 'opt/google/chrome/WidevineCdm/'
+CDM_PATH = CDM_DIR + '_platform_specific/cros_arm64/libwidevinecdm.so'
+
+
+def write_sparse(path, chunks):
+    """Write a file of (offset, data) chunks, leaving holes in between"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as sparse_file:
+        for offset, data in chunks:
+            sparse_file.seek(offset)
+            sparse_file.write(data)
+
+
+def build_image(work_dir, fstype, options):
+    """
+    Build a Chrome OS like image from the files in work_dir/root: a GPT disk whose ROOT-A partition holds a filesystem made by mke2fs
+
+    Returns the path of the image and of a ZIP archive holding it.
+    """
+    fs_path = os.path.join(work_dir, 'fs.img')
+    subprocess.check_call(['mke2fs', '-F', '-q', '-t', fstype, '-b', '1024', '-d', os.path.join(work_dir, 'root')] + options + [fs_path, '32M'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    lba_size = config.CHROMEOS_BLOCK_SIZE
+    first_lba = 64
+    header = struct.pack('<8s4sII4x4Q16sQ3I', b'EFI PART', b'\x00\x00\x01\x00', 92, 0, 1, 0, 34, 0, bytes(16), 2, 4, 128, 0)
+    entries = b''.join(struct.pack('<16s16sQQQ72s', b'\x01' * 16, b'\x02' * 16, first_lba if name == 'ROOT-A' else 0, 0, 0, name.encode('utf-16-le'))
+                       for name in ('STATE', 'KERN-A', 'ROOT-A', 'ROOT-B'))
+    disk = bytearray(first_lba * lba_size)
+    disk[lba_size:lba_size + len(header)] = header
+    disk[2 * lba_size:2 * lba_size + len(entries)] = entries
+
+    image_path = os.path.join(work_dir, 'chromeos_1.2.3_test_recovery.bin')
+    with open(image_path, 'wb') as image, open(fs_path, 'rb') as filesystem:
+        image.write(disk)
+        image.write(filesystem.read())
+    with ZipFile(image_path + '.zip', 'w', ZIP_DEFLATED) as zip_obj:
+        zip_obj.write(image_path, os.path.basename(image_path))
+    return image_path, image_path + '.zip'
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves the file at path, honouring byte ranges, and breaks off every response after cut_after bytes if set"""
+    protocol_version = 'HTTP/1.1'
+    path = None
+    cut_after = None
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        ImageHandler.requests += 1
+        with open(ImageHandler.path, 'rb') as image:
+            data = image.read()
+        start = int(self.headers['Range'][len('bytes='):].split('-')[0]) if self.headers.get('Range') else 0
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if self.cut_after:
+            data = data[:start + self.cut_after]
+            self.close_connection = True
+        try:
+            self.wfile.write(data[start:])
+        except ConnectionError:  # The image was extracted before the download finished
+            pass
+
+
+@unittest.skipUnless(which('mke2fs'), 'Skipping Chrome OS image tests without mke2fs')
+class ChromeOSImageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+        self.root = os.path.join(self.work_dir, 'root')
+        write_sparse(os.path.join(self.root, CDM_PATH), [(0, os.urandom(300 * 1024 + 123))])  # 1 KiB blocks: reaches the doubly indirect block
+        write_sparse(os.path.join(self.root, CDM_DIR, 'manifest.json'), [(0, b'{"version": "4.10.2662.3"}')])
+
+    def tearDown(self):
+        rmtree(self.work_dir)
+
+    def assertExtracted(self, image_path, paths, index=None):  # pylint: disable=invalid-name
+        """Extract the libwidevinecdm.so and the paths from the image and compare them to the originals, returns the extraction index"""
+        extract_path = os.path.join(self.work_dir, 'extracted')
+        rmtree(extract_path, ignore_errors=True)
+        image = ChromeOSImage(image_path, index=index)
+        try:
+            extracted = image.extract_files(['libwidevinecdm.so'] + paths, extract_path)
+        finally:
+            image.close()
+        self.assertEqual(extracted, ['libwidevinecdm.so'] + paths)
+        for path in [CDM_PATH] + paths:
+            with open(os.path.join(self.root, path), 'rb') as original, open(os.path.join(extract_path, os.path.basename(path)), 'rb') as copy:
+                self.assertEqual(original.read(), copy.read(), path)
+        return image.extraction_index()
+
+    def test_ext2_indirect_blocks(self):
+        # A sparse file whose last block is mapped by the triply indirect block
+        write_sparse(os.path.join(self.root, 'usr/lib/sparse.bin'), [(0, os.urandom(5000)), (65 * 1024 * 1024, os.urandom(3000))])
+        paths = [CDM_DIR + 'manifest.json', 'usr/lib/sparse.bin']
+        image_path, zip_path = build_image(self.work_dir, 'ext2', [])
+
+        self.assertExtracted(image_path, paths)
+        self.assertExtracted(zip_path, paths)
+
+    def test_reuse_index(self):
+        # Extracting again with the saved index reads the runs it recorded, without looking the files up
+        write_sparse(os.path.join(self.root, 'usr/lib/sparse.bin'), [(0, os.urandom(5000)), (65 * 1024 * 1024, os.urandom(3000))])
+        paths = [CDM_DIR + 'manifest.json', 'usr/lib/sparse.bin']
+        image_path, zip_path = build_image(self.work_dir, 'ext2', [])
+
+        index = self.assertExtracted(image_path, paths)
+        self.assertEqual(index['files']['usr/lib/sparse.bin']['size'], 65 * 1024 * 1024 + 3000)
+        self.assertExtracted(image_path, paths, index=index)
+        self.assertExtracted(zip_path, paths, index=json.loads(json.dumps(index)))  # as saved and loaded by save_chromeos_index
+
+    def test_ext4_extent_tree(self):
+        # More extents than fit in the inode need an extent tree, and few inodes per group spread the files over the 64bit block groups
+        write_sparse(os.path.join(self.root, 'usr/lib/islands.bin'), [(num * 64 * 1024, os.urandom(4096)) for num in range(12)])
+        paths = [CDM_DIR + 'manifest.json', 'usr/lib/islands.bin']
+        for num in range(40):
+            write_sparse(os.path.join(self.root, 'usr/share/file{}.txt'.format(num)), [(0, os.urandom(num * 100))])
+            paths.append('usr/share/file{}.txt'.format(num))
+        image_path, zip_path = build_image(self.work_dir, 'ext4', ['-O', '64bit', '-N', '64'])
+
+        index = self.assertExtracted(image_path, paths)
+        self.assertExtracted(zip_path, paths)
+        self.assertExtracted(image_path, paths, index=index)
+
+    def test_stream_url(self):
+        paths = [CDM_DIR + 'manifest.json']
+        _, zip_path = build_image(self.work_dir, 'ext2', [])
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/{}'.format(server.server_address[1], os.path.basename(zip_path))
+        http_session().set_proxies(None)  # Forget proxies set by other tests
+        yesno_dialog = utils.yesno_dialog
+        try:
+            ImageHandler.path, ImageHandler.cut_after, ImageHandler.requests = zip_path, None, 0
+            self.assertExtracted(url, paths)
+            requests = ImageHandler.requests
+
+            # Downloads that break off are resumed at the raw position where they broke off
+            ImageHandler.cut_after, ImageHandler.requests = 16 * 1024, 0
+            self.assertExtracted(url, paths)
+            self.assertGreater(ImageHandler.requests, requests)
+
+            utils.yesno_dialog = lambda *args, **kwargs: False  # Do not try again
+            ImageHandler.path = ImageHandler.path + '.missing'
+            with self.assertRaises(ChromeOSError):
+                ChromeOSImage(url)
+        finally:
+            utils.yesno_dialog = yesno_dialog
+            server.shutdown()
+            server.server_close()
+
+    def test_scan_parallel(self):
+        # Several low priority processes find the same directory entries as a single pass does
+        image_path, _ = build_image(self.work_dir, 'ext2', [])
+        min_size, processes = config.CHROMEOS_PARALLEL_SCAN_MIN_SIZE, config.CHROMEOS_SCAN_PROCESSES
+        image = ChromeOSImage(image_path)
+        try:
+            found = image._find_files_naive(['libwidevinecdm.so', 'manifest.json'])  # pylint: disable=protected-access
+            config.CHROMEOS_PARALLEL_SCAN_MIN_SIZE, config.CHROMEOS_SCAN_PROCESSES = 0, 4
+            self.assertEqual(image._find_files_naive(['libwidevinecdm.so', 'manifest.json']), found)  # pylint: disable=protected-access
+        finally:
+            config.CHROMEOS_PARALLEL_SCAN_MIN_SIZE, config.CHROMEOS_SCAN_PROCESSES = min_size, processes
+            image.close()
+        self.assertEqual(sorted(found), ['libwidevinecdm.so', 'manifest.json'])
+
+    def test_find_and_lookup(self):
+        image_path, zip_path = build_image(self.work_dir, 'ext2', [])
+        for path in (image_path, zip_path):
+            image = ChromeOSImage(path)
+            try:
+                cdm_inode = image.lookup(CDM_PATH)
+                self.assertIsNotNone(cdm_inode)
+                self.assertEqual(image.find_file('libwidevinecdm.so').inode, cdm_inode)
+                self.assertEqual(image.find_file('libwidevinecdm.so', path_to_file=('opt', 'google', 'chrome')).inode, cdm_inode)
+                self.assertIsNone(image.lookup('opt/google/missing'))
+            finally:
+                image.close()
+
+    def test_missing_file(self):
+        image_path, _ = build_image(self.work_dir, 'ext2', [])
+        image = ChromeOSImage(image_path)
+        try:
+            extracted = image.extract_files(['libwidevinecdm.so', 'opt/google/missing.so'], os.path.join(self.work_dir, 'extracted'))
+        finally:
+            image.close()
+        self.assertEqual(extracted, ['libwidevinecdm.so'])
+        self.assertIsNone(image.extraction_index()['files']['opt/google/missing.so'])
+
+
+class FailingStream(BytesIO):
+    """A stream that fails the first time reading reaches fail_at"""
+
+    def __init__(self, data, fail_at):
+        super().__init__(data)
+        self.fail_at = fail_at
+
+    def read(self, size=-1):
+        if self.fail_at is not None and self.tell() + size > self.fail_at:
+            self.fail_at = None
+            raise ChromeOSError('Read failed')
+        return super().read(size)
+
+
+class PipelinedStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(100 * 1000 + 7)
+
+    def test_read(self):
+        stream = PipelinedStream(BytesIO(self.data), 1000, 4)
+        try:
+            self.assertEqual(stream.read(10), self.data[:10])
+            buffer = bytearray(2500)
+            self.assertEqual(stream.readinto(buffer), 2500)
+            self.assertEqual(bytes(buffer), self.data[10:2510])
+            self.assertEqual(stream.read(len(self.data)), self.data[2510:])
+            self.assertEqual(stream.read(10), b'')
+            self.assertEqual(stream.tell(), len(self.data))
+        finally:
+            stream.close()
+
+    def test_seek(self):
+        stream = PipelinedStream(BytesIO(self.data), 1000, 4)
+        try:
+            self.assertEqual(stream.seek(50 * 1000 + 3), 50 * 1000 + 3)  # Forward, dropping buffered data
+            self.assertEqual(stream.read(10), self.data[50 * 1000 + 3:50 * 1000 + 13])
+            self.assertEqual(stream.seek(1234), 1234)  # Backwards, restarting the producer
+            self.assertEqual(stream.read(2000), self.data[1234:3234])
+            self.assertEqual(stream.seek(len(self.data) + 10), len(self.data))  # Beyond the end
+            self.assertEqual(stream.read(10), b'')
+            self.assertEqual(stream.seek(0), 0)
+            self.assertEqual(stream.read(len(self.data)), self.data)
+        finally:
+            stream.close()
+
+    def test_error(self):
+        # The error of the producer is raised once the buffered data before it is read, after seeking backwards reading works again
+        stream = PipelinedStream(FailingStream(self.data, 5500), 1000, 4)
+        try:
+            self.assertEqual(stream.read(5000), self.data[:5000])
+            with self.assertRaises(ChromeOSError):
+                stream.read(1000)
+            self.assertEqual(stream.seek(10), 10)
+            self.assertEqual(stream.read(10), self.data[10:20])
+            self.assertEqual(stream.read(len(self.data)), self.data[20:])
+        finally:
+            stream.close()
+        self.assertFalse(stream.thread.is_alive())
+
+
+class RecoveryHandler(BaseHTTPRequestHandler):
+    """Serves the gzipped recovery configuration devices with etag, answers 304 when the client already has it and 503 when unavailable"""
+    protocol_version = 'HTTP/1.1'
+    devices = []
+    etag = '"1"'
+    requests = []
+    unavailable = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.unavailable:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        data = gzip.compress(json.dumps(self.devices).encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ChromeOSConfigTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RecoveryHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        http_session().set_proxies(None)  # Forget proxies set by other tests
+        self.recovery_url = config.CHROMEOS_RECOVERY_URL
+        config.CHROMEOS_RECOVERY_URL = 'http://127.0.0.1:{}/recovery.json'.format(self.server.server_address[1])
+        self.ttl = get_setting('recovery_cache_ttl')
+        arm_bname = config.CHROMEOS_RECOVERY_ARM64_BNAMES[0]
+        RecoveryHandler.devices = [{'file': 'chromeos_15886.44.0_octopus_recovery_stable-channel_mp-v2.bin'},
+                                   {'file': 'chromeos_15886.44.0_{}_recovery_stable-channel_mp-v2.bin'.format(arm_bname)}]
+        RecoveryHandler.etag = '"1"'
+        RecoveryHandler.requests = []
+        RecoveryHandler.unavailable = False
+
+    def tearDown(self):
+        config.CHROMEOS_RECOVERY_URL = self.recovery_url
+        set_setting('recovery_cache_ttl', self.ttl)
+        if os.path.exists(chromeos_config_cache_path()):
+            os.remove(chromeos_config_cache_path())
+
+    def test_cache(self):
+        set_setting('recovery_cache_ttl', 24)
+        self.assertEqual(chromeos_config(), RecoveryHandler.devices[1:])
+        self.assertEqual(chromeos_config(), RecoveryHandler.devices[1:])  # From the cache
+        self.assertEqual(RecoveryHandler.requests, [None])
+
+    def test_not_modified(self):
+        set_setting('recovery_cache_ttl', 0)  # Revalidate every time
+        devices = RecoveryHandler.devices[1:]
+        self.assertEqual(chromeos_config(), devices)
+        cached_time = load_chromeos_config_cache()['time']
+        self.assertEqual(chromeos_config(), devices)
+        self.assertGreaterEqual(load_chromeos_config_cache()['time'], cached_time)
+        self.assertEqual(RecoveryHandler.requests, [None, '"1"'])
+
+        # The configuration changed on the server
+        RecoveryHandler.devices = RecoveryHandler.devices[:1] + [{'file': RecoveryHandler.devices[1]['file'].replace('15886', '15887')}]
+        RecoveryHandler.etag = '"2"'
+        self.assertEqual(chromeos_config(), RecoveryHandler.devices[1:])
+        self.assertEqual(load_chromeos_config_cache()['etag'], '"2"')
+        self.assertEqual(RecoveryHandler.requests, [None, '"1"', '"1"'])
+
+    def test_unavailable(self):
+        set_setting('recovery_cache_ttl', 0)
+        self.assertEqual(chromeos_config(), RecoveryHandler.devices[1:])
+        RecoveryHandler.unavailable = True
+        yesno_dialog = utils.yesno_dialog
+        utils.yesno_dialog = lambda *args, **kwargs: False  # Do not try again
+        try:
+            self.assertEqual(chromeos_config(), RecoveryHandler.devices[1:])  # The outdated cache
+            os.remove(chromeos_config_cache_path())
+            self.assertIsNone(chromeos_config())
+        finally:
+            utils.yesno_dialog = yesno_dialog
+
+
+class FakeResponse(BytesIO):
+    """A downloaded file with HTTP headers"""
+
+    def __init__(self, data, headers):
+        super().__init__(data)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+
+class ChromeOSDevicesTests(unittest.TestCase):
+
+    def setUp(self):
+        arm_bname = config.CHROMEOS_RECOVERY_ARM64_BNAMES[0]
+        self.arm_devices = [{'file': 'chromeos_15886.44.0_{}_recovery_stable-channel_mp-v2.bin'.format(arm_bname), 'sha1': '0' * 40, 'zipfilesize': '1'},
+                            {'file': 'chromeos_15886.44.0_{}_recovery_stable-channel_mp-v3.bin'.format(arm_bname), 'name': 'Ünicode ✓'}]
+        self.devices = [{'file': 'chromeos_15886.44.0_octopus_recovery_stable-channel_mp-v2.bin', 'desc': ' ,[]{} ' * 100}, self.arm_devices[0],
+                        {'file': 'no_board'}, 'not a device', self.arm_devices[1]]
+
+    def test_parse_gzip(self):
+        data = gzip.compress(json.dumps(self.devices, indent=4, ensure_ascii=False).encode('utf-8'))
+        for chunk_size in (1, 7, 100, 64 * 1024):
+            self.assertEqual(parse_chromeos_devices(FakeResponse(data, {'content-encoding': 'gzip'}), chunk_size=chunk_size), self.arm_devices)
+
+    def test_parse_plain(self):
+        data = json.dumps(self.devices).encode('utf-8')
+        self.assertEqual(parse_chromeos_devices(FakeResponse(data, {}), chunk_size=5), self.arm_devices)
+
+    def test_parse_invalid(self):
+        data = json.dumps(self.devices).encode('utf-8')
+        with self.assertRaises(ValueError):
+            parse_chromeos_devices(FakeResponse(data[:-20], {}))
+        with self.assertRaises(ValueError):
+            parse_chromeos_devices(FakeResponse(gzip.compress(b'{"file": "x"}'), {'content-encoding': 'gzip'}))
+
+
+class ChromeOSIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.work_dir)
+        remove_chromeos_indexes()
+
+    def test_load_and_save(self):
+        save_chromeos_index('/tmp/chromeos_15886.44.0_board_recovery.bin.zip', 'a' * 40, {'files': {}})
+        self.assertEqual(load_chromeos_index('other.bin', 'a' * 40), ({'files': {}, 'file': 'chromeos_15886.44.0_board_recovery.bin.zip'}, 'a' * 40))
+        # Without a sha1, the index is found by the name of the image, zipped or not
+        self.assertEqual(load_chromeos_index('/tmp/chromeos_15886.44.0_board_recovery.bin')[1], 'a' * 40)
+        self.assertEqual(load_chromeos_index('/tmp/chromeos_15886.44.1_board_recovery.bin'), (None, None))
+        save_chromeos_index('chromeos_15886.44.0_board_recovery.bin.zip', 'a' * 40, None)
+        self.assertEqual(load_chromeos_indexes(), {})
+
+    def test_remove_indexes(self):
+        for version, sha1 in (('15886.44.0', 'a' * 40), ('15886.45.0', 'b' * 40), ('15886.46.0', 'c' * 40)):
+            save_chromeos_index('chromeos_{}_board_recovery.bin.zip'.format(version), sha1, {'files': {}})
+        save_chromeos_index('manual.bin', 'd' * 40, {'files': {}})
+        for version in ('15886.45.0', '15886.46.0', '4.10.2662.3'):
+            os.mkdir(os.path.join(self.work_dir, version))
+
+        remove_chromeos_indexes(self.work_dir)
+        self.assertEqual(sorted(load_chromeos_indexes()), ['b' * 40, 'c' * 40])
+        remove_chromeos_indexes()
+        self.assertFalse(os.path.exists(chromeos_index_path()))
+
+
+class ELFBinaryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.work_dir)
+
+    def elf_file(self, is_64bit=True, machine=183, elf_type=3, size=4096, filesz=4096):
+        """Write a shared library with one segment of filesz bytes, truncated or padded to size bytes"""
+        if is_64bit:
+            ident = b'\x7fELF\x02\x01\x01' + bytes(9)
+            header = struct.pack('<2HI3QI6H', elf_type, machine, 1, 0, 64, 0, 0, 64, 56, 1, 64, 0, 0)
+            phdr = struct.pack('<2I6Q', 1, 5, 0, 0, 0, filesz, filesz, 4096)
+        else:
+            ident = b'\x7fELF\x01\x01\x01' + bytes(9)
+            header = struct.pack('<2H5I6H', elf_type, machine, 1, 0, 52, 0, 0, 52, 32, 1, 40, 0, 0)
+            phdr = struct.pack('<8I', 1, 0, 0, 0, filesz, filesz, 5, 4096)
+        path = os.path.join(self.work_dir, 'libwidevinecdm.so')
+        with open(path, 'wb') as elf:
+            elf.write((ident + header + phdr).ljust(size, b'\x00')[:size])
+        return path
+
+    def test_valid(self):
+        self.assertTrue(elfbinary_valid(self.elf_file()))
+        self.assertTrue(elfbinary_valid(self.elf_file(is_64bit=False, machine=40)))
+
+    def test_truncated(self):
+        self.assertFalse(elfbinary_valid(self.elf_file(size=2048)))
+        self.assertFalse(elfbinary_valid(self.elf_file(size=70)))
+        self.assertFalse(elfbinary_valid(self.elf_file(size=10)))
+
+    def test_not_arm_library(self):
+        self.assertFalse(elfbinary_valid(self.elf_file(machine=62)))  # x86-64
+        self.assertFalse(elfbinary_valid(self.elf_file(elf_type=2)))  # executable
+        path = os.path.join(self.work_dir, 'libwidevinecdm.so')
+        with open(path, 'wb') as not_elf:
+            not_elf.write(b'<html>Not found</html>')
+        self.assertFalse(elfbinary_valid(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
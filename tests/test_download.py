@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v3.0 (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# pylint: disable=missing-docstring
+
+import json
+import os
+import unittest
+from time import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+from hashlib import sha1, sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from inputstreamhelper import config, utils
+from inputstreamhelper.kodiutils import addon_profile
+from inputstreamhelper.utils import (_load_mirror_speeds as load_mirror_speeds, _partial_download, _same_file, _save_partial, _split_segments, ChunkWorker,
+                                     http_download, http_session, rank_mirrors, remove_partials)
+
+DATA = os.urandom(5 * 1024 * 1024 + 123)
+ETAG = '"{}"'.format(sha1(DATA).hexdigest())
+OTHER_DATA = os.urandom(len(DATA))  # Another version of the file
+CUT_SIZE = 1024 * 1024
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA at every path, honouring single byte ranges, and records the paths and Range headers it gets
+
+    Mirrors are told apart by the first directory of the path: /cut/ breaks off every response after CUT_SIZE bytes,
+    /other/ serves another version of the file and /missing/ answers 404.
+    """
+    protocol_version = 'HTTP/1.1'
+    ranges = []
+    paths = []
+    empty_ranges = False  # Answer byte range requests without a body
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        data, etag = (OTHER_DATA, '"other"') if self.path.startswith('/other/') else (DATA, ETAG)
+        start, end = 0, len(data) - 1
+        byte_range = self.headers.get('Range')
+        self.ranges.append(byte_range)
+        self.paths.append(self.path)
+        if self.path.startswith('/missing/'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if byte_range:
+            first, last = byte_range[len('bytes='):].split('-')
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+            if self.empty_ranges:
+                end = start - 1
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if self.path.startswith('/cut/'):
+            end = min(end, start + CUT_SIZE - 1)
+            self.close_connection = True
+        try:
+            self.wfile.write(data[start:end + 1])
+        except ConnectionError:  # The client only needed the headers
+            pass
+
+
+class DownloadTestCase(unittest.TestCase):
+    """Runs a local HTTP server serving DATA, and removes what was downloaded from it after every test"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = cls.mirror('')
+
+    @classmethod
+    def mirror(cls, name):
+        """The URL of the file on the mirror with the given name"""
+        return 'http://127.0.0.1:{}/{}chromeos_1.2.3_test_recovery.bin.zip'.format(cls.server.server_address[1], name + '/' if name else '')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        http_session().set_proxies(None)  # Forget proxies set by other tests
+        RangeHandler.ranges = []
+        RangeHandler.paths = []
+        RangeHandler.empty_ranges = False
+        self.min_range_size = config.HTTP_DOWNLOAD_MIN_RANGE_SIZE
+        self.yesno_dialog = utils.yesno_dialog
+        self.rank_mirrors = utils.rank_mirrors
+
+    def tearDown(self):
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = self.min_range_size
+        utils.yesno_dialog = self.yesno_dialog
+        utils.rank_mirrors = self.rank_mirrors
+        remove_partials()
+        for path in (utils.download_path(self.url), os.path.join(addon_profile(), config.HTTP_MIRRORS_FILE)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def assertDownloaded(self, path):  # pylint: disable=invalid-name
+        self.assertTrue(path)
+        with open(path, 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), DATA)
+        self.assertFalse(any(os.path.exists(partial) for partial in _partial_download(self.url)))
+
+
+class SplitSegmentsTests(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(_split_segments([[0, 99]], 4), [[0, 24], [25, 49], [50, 74], [75, 99]])
+        self.assertEqual(_split_segments([[0, 9]], 3), [[0, 3], [4, 7], [8, 9]])
+
+    def test_split_remaining(self):
+        # Finished segments are dropped, the others are split again to keep every connection busy
+        self.assertEqual(_split_segments([[25, 24], [40, 49], [50, 49], [90, 99]], 4), [[40, 44], [45, 49], [90, 94], [95, 99]])
+        self.assertEqual(_split_segments([[0, 9], [20, 29], [40, 49]], 2), [[0, 9], [20, 29], [40, 49]])
+        self.assertEqual(_split_segments([[10, 9]], 4), [])
+
+    def test_split_small(self):
+        self.assertEqual(_split_segments([[5, 6]], 4), [[5, 5], [6, 6]])
+
+
+class RangeDownloadTests(DownloadTestCase):
+
+    def test_download_ranges(self):
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024
+        self.assertDownloaded(http_download(self.url, checksum=sha1(DATA).hexdigest(), background=True, connections=4))
+        self.assertEqual(RangeHandler.ranges[0], None)
+        self.assertEqual(sorted(int(byte_range[len('bytes='):].split('-')[0]) for byte_range in RangeHandler.ranges[1:]),
+                         [0, 1310751, 2621502, 3932253])
+
+    def test_empty_ranges(self):
+        # An empty body counts as a failed try, so every range gives up after its retries
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024
+        RangeHandler.empty_ranges = True
+        utils.yesno_dialog = lambda *args, **kwargs: False  # Do not try again
+        self.assertFalse(http_download(self.url, background=True, connections=4))
+        self.assertEqual(len(RangeHandler.ranges), 1 + 4 * 4)
+
+
+class ResumeDownloadTests(DownloadTestCase):
+
+    def save_partial(self, size, url=None):
+        """Store the first size bytes of DATA as an interrupted download, with its sidecar file"""
+        url = url or self.url
+        part_path, _ = _partial_download(url)
+        with open(part_path, 'wb') as part:
+            part.write(DATA[:size])
+        _save_partial({'url': url, 'size': len(DATA), 'validator': ETAG, 'hash_alg': 'sha1', 'segments': [[size, len(DATA) - 1]],
+                       'digest': sha1(DATA[:size]).hexdigest()})
+
+    def test_download(self):
+        self.assertDownloaded(http_download(self.url, checksum=sha1(DATA).hexdigest(), background=True))
+        self.assertEqual(RangeHandler.ranges, [None])
+
+    def test_resume_stream(self):
+        self.save_partial(1024 * 1024)
+        self.assertDownloaded(http_download(self.url, checksum=sha1(DATA).hexdigest(), background=True))
+        self.assertEqual(RangeHandler.ranges, [None, 'bytes={}-{}'.format(1024 * 1024, len(DATA))])
+
+    def test_resume_ranges(self):
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024
+        self.save_partial(1024 * 1024)
+        self.assertDownloaded(http_download(self.url, checksum=sha1(DATA).hexdigest(), background=True, connections=4))
+        starts = sorted(int(byte_range[len('bytes='):].split('-')[0]) for byte_range in RangeHandler.ranges[1:])
+        self.assertEqual(len(starts), 4)
+        self.assertEqual(starts[0], 1024 * 1024)
+
+    def test_discard_changed(self):
+        self.save_partial(1024 * 1024)
+        with open(_partial_download(self.url)[0], 'r+b') as part:
+            part.write(b'corrupted')  # No longer matches the checksum in the sidecar file
+        self.assertDownloaded(http_download(self.url, checksum=sha1(DATA).hexdigest(), background=True))
+        self.assertEqual(RangeHandler.ranges, [None])  # Started over
+
+    def test_save_partial_snapshot(self):
+        # The sidecar file records the segments as they were when saving, not as the range threads advance them later on
+        self.save_partial(1024)
+        state = {'url': self.url, 'size': len(DATA), 'validator': ETAG, 'hash_alg': 'sha1', 'segments': [[1024, 2047], [4096, 8191]], 'digest': None}
+        _save_partial(state)
+        state['segments'][0][0] = 2048
+        with open(_partial_download(self.url)[1], 'r', encoding='utf-8') as sidecar:
+            self.assertEqual(json.load(sidecar)['segments'], [[1024, 2047], [4096, 8191]])
+
+    def test_remove_partials(self):
+        other_url = self.url.replace('chromeos_1.2.3', 'chromeos_1.2.2')
+        old_url = self.url.replace('chromeos_1.2.3', 'chromeos_1.2.1')
+        for url in (self.url, other_url, old_url):
+            self.save_partial(1024, url)
+        for path in _partial_download(old_url):
+            os.utime(path, (time() - 3600, time() - 3600))
+
+        remove_partials(max_age=60)
+        self.assertFalse(any(os.path.exists(path) for path in _partial_download(old_url)))
+        self.assertTrue(all(os.path.exists(path) for path in _partial_download(other_url)))
+        remove_partials(keep_url=self.url)
+        self.assertFalse(any(os.path.exists(path) for path in _partial_download(other_url)))
+        self.assertTrue(all(os.path.exists(path) for path in _partial_download(self.url)))
+        remove_partials()
+        self.assertFalse(any(os.path.exists(path) for path in _partial_download(self.url)))
+
+
+def fake_response(headers):
+    """An HTTP response with the given headers"""
+    return SimpleNamespace(info=lambda: headers)
+
+
+class MirrorTests(DownloadTestCase):
+
+    def setUp(self):
+        super().setUp()
+        utils.rank_mirrors = list  # Keep the order of the mirrors, unless a test ranks them
+
+    def test_same_file(self):
+        state = {'validator': ETAG, 'size': 1000}
+        self.assertTrue(_same_file(fake_response({'etag': ETAG, 'content-range': 'bytes 10-999/1000'}), state))
+        self.assertFalse(_same_file(fake_response({'etag': '"other"', 'content-range': 'bytes 10-999/1000'}), state))
+        self.assertFalse(_same_file(fake_response({'etag': ETAG, 'content-range': 'bytes 10-999/1001'}), state))
+        self.assertFalse(_same_file(fake_response({'etag': ETAG}), state))
+        state['validator'] = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.assertTrue(_same_file(fake_response({'last-modified': state['validator'], 'content-range': 'bytes 0-9/1000'}), state))
+
+    def test_rank_mirrors(self):
+        utils.rank_mirrors = self.rank_mirrors
+        self.assertEqual(rank_mirrors([self.mirror('missing'), self.url])[-1], self.mirror('missing'))
+        self.assertEqual(rank_mirrors([self.url]), [self.url])
+
+    def test_failover_stream(self):
+        # The first mirror breaks off, the download continues from where it stopped on the next one
+        self.assertDownloaded(http_download(self.mirror('cut'), checksum=sha1(DATA).hexdigest(), background=True, mirrors=[self.url]))
+        self.assertEqual(RangeHandler.paths, [urlsplit(self.mirror('cut')).path, urlsplit(self.url).path])
+        self.assertEqual(RangeHandler.ranges, [None, 'bytes={}-{}'.format(CUT_SIZE, len(DATA))])
+        self.assertEqual(sorted(load_mirror_speeds()), ['127.0.0.1:{}'.format(self.server.server_address[1])])
+
+    def test_failover_other_version(self):
+        # A mirror serving another version of the file is skipped instead of resumed from
+        mirrors = [self.mirror('other'), self.url]
+        self.assertDownloaded(http_download(self.mirror('cut'), checksum=sha1(DATA).hexdigest(), background=True, mirrors=mirrors))
+        self.assertEqual(RangeHandler.paths, [urlsplit(url).path for url in [self.mirror('cut')] + mirrors])
+        self.assertEqual(RangeHandler.ranges[1:], ['bytes={}-{}'.format(CUT_SIZE, len(DATA))] * 2)
+
+    def test_failover_bounded(self):
+        # After every mirror failed, it asks to try again instead of rotating forever
+        utils.yesno_dialog = lambda *args, **kwargs: False  # Do not try again
+        self.assertFalse(http_download(self.mirror('cut'), background=True, mirrors=[self.mirror('other')]))
+        self.assertEqual(len(RangeHandler.paths), 2)
+
+    def test_failover_ranges(self):
+        # Ranges that break off on the first mirror continue on the next one
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024
+        self.assertDownloaded(http_download(self.mirror('cut'), checksum=sha1(DATA).hexdigest(), background=True, connections=2, mirrors=[self.url]))
+        self.assertIn(urlsplit(self.url).path, RangeHandler.paths[1:])
+        self.assertEqual(len(RangeHandler.paths), 1 + 2 * 2)
+
+
+class ChunkWorkerTests(DownloadTestCase):
+
+    def test_consume(self):
+        chunks, lengths = [], []
+        worker = ChunkWorker(chunks.append, lambda chunk: lengths.append(len(chunk)))
+        try:
+            for num in range(100):
+                worker.put(bytes([num]) * num)
+            worker.sync()
+            self.assertEqual(chunks, [bytes([num]) * num for num in range(100)])
+            self.assertEqual(lengths, list(range(100)))
+        finally:
+            worker.close()
+        self.assertFalse(worker.thread.is_alive())
+
+    def test_error(self):
+        # The error of a consumer is raised in the producing thread, which never blocks on the full queue
+        def consume(chunk):
+            if chunk == b'fail':
+                raise OSError('No space left on device')
+
+        worker = ChunkWorker(consume)
+        try:
+            worker.put(b'fail')
+            with self.assertRaises(OSError):
+                for _ in range(10 * config.HTTP_DOWNLOAD_QUEUE_SIZE):
+                    worker.put(b'chunk')
+            with self.assertRaises(OSError):
+                worker.sync()
+        finally:
+            worker.close()
+
+    def test_sha256(self):
+        self.assertDownloaded(http_download(self.url, checksum=sha256(DATA).hexdigest(), hash_alg='sha256', background=True))
+        config.HTTP_DOWNLOAD_MIN_RANGE_SIZE = 1024
+        self.assertDownloaded(http_download(self.url, checksum=sha256(DATA).hexdigest(), hash_alg='sha256', background=True, connections=4))
+
+    def test_wrong_checksum(self):
+        utils.yesno_dialog = lambda *args, **kwargs: False  # Do not keep the file
+        self.assertFalse(http_download(self.url, checksum=sha256(b'').hexdigest(), hash_alg='sha256', background=True))
+
+
+if __name__ == '__main__':
+    unittest.main()